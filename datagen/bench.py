@@ -0,0 +1,599 @@
+'''
+bench.py
+
+Benchmark suite, run with `datagen bench`.
+
+Micro-benchmarks time each dictionary, number type, sampling distribution,
+grammar and encoder on its own. The end-to-end benchmarks run the sample
+template against a NullInterface, which still pays for encoding every
+document to BSON, compare long bodies with and without a text pool, compare
+serial writes with --writers against a sink that fakes a server's latency,
+and time a cold start of the command line tool. Memory benchmarks report the
+peak traced memory of keeping a collection's ids, and the memory of each
+worker process with and without --share-dictionaries. Results are written as JSON;
+`datagen bench --compare OLD NEW` compares two result files and flags
+regressions. Results with a target in TARGETS are also checked against it.
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datagen import dictionaries
+from datagen import distributions
+from datagen import encoders
+from datagen import generator
+from datagen import grammars
+from datagen import idstore
+from datagen import streams
+from datagen.output_methods import NullInterface
+from datagen.output_methods import PipelinedInterface
+
+__sample__ = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                          "../templates/template.json"))
+
+# (benchmark name, dictionary name, generate_data() options)
+DICTIONARY_CASES = [
+    ("dictionary.names",        "names",   {"size": 1,
+                                            "subfield": "full_name"}),
+    ("dictionary.words",        "words",   {"size": (5, 20)}),
+    ("dictionary.lipsum",       "lipsum",  {"size": (40, 60)}),
+    ("dictionary.numbers",      "numbers", {"size": 20,
+                                            "field_type": "number"}),
+    ("dictionary.numbers.telno", "numbers", {"size": 1,
+                                             "field_type": "us-telno"})
+]
+
+# (benchmark name, field type, generate_batch() options) for each number type
+NUMBER_CASES = [
+    ("numbers.digits",  "number",   {"size": 20}),
+    ("numbers.telno",   "us-telno", {"size": 1}),
+    ("numbers.ssn",     "us-ssn",   {"size": 1}),
+    ("numbers.int",     "int",      {"size": 1, "min": 0, "max": 10 ** 9}),
+    ("numbers.float",   "float",    {"size": 1}),
+    ("numbers.decimal", "decimal",  {"size": 1, "max": 10 ** 6, "scale": 2})
+]
+NUMBER_BATCH = 256  # Documents per generate_batch() call, as in a block
+
+# (benchmark name, words distribution)
+DISTRIBUTION_CASES = [
+    ("distribution.uniform", "uniform"),
+    ("distribution.zipf",    "zipf:1.1")
+]
+DISTRIBUTION_WORDS = 10     # Words per document
+
+# (benchmark name, grammar function, number of words)
+GRAMMAR_CASES = [
+    ("grammar.headline",  grammars.headline,  8),
+    ("grammar.sentence",  grammars.sentence,  10),
+    ("grammar.body",      grammars.body,      50),
+    ("grammar.body.500",  grammars.body,      500),
+    ("grammar.json_list", grammars.json_list, 5)
+]
+
+# A collection of long bodies, generated with and without a text pool.
+BODY_TEMPLATE = [{"collection_name": "bodies", "count": 1, "fields": [
+    {"name": "body", "type": "body", "size": [400, 600],
+     "generator": "lipsum"}]}]
+
+PIPELINE_WRITERS = (1, 2, 4)    # --writers values compared with serial writes
+PIPELINE_LATENCY = 0.005        # Seconds each faked batch write takes
+PIPELINE_BATCH   = 100          # Documents per batch
+
+IDSTORE_COUNT = 200000   # ObjectIds kept by the idstore benchmarks
+IDSTORE_BATCH = 1000     # Ids per batch, as an output hands them back
+
+SHARE_WORKERS = 4        # Worker processes in the share_dictionaries runs
+
+# Units of results that are better lower. Everything else is a rate.
+LOWER_BETTER = ("s", "MB")
+
+# Targets some results must meet, in their units: times at most, rates at
+# least.
+TARGETS = {
+    "cold_start": 0.1   # Seconds
+}
+
+# A numbers-only template, which loads no dictionary files.
+COLD_TEMPLATE = [{"collection_name": "numbers", "count": 1, "fields": [
+    {"name": "number", "size": 5, "generator": "numbers"}]}]
+
+def parse_args(argv):
+    '''
+    Set up the bench argument parser.
+    :param argv:
+    '''
+    parser = argparse.ArgumentParser(prog="datagen bench",
+                                     description="Benchmark datagen.")
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="Write results to this file instead of stdout.")
+    parser.add_argument("--duration", type=float, default=0.5,
+                        help="Seconds to spend on each micro-benchmark. \
+                              Default: 0.5")
+    parser.add_argument("--count", type=int, default=5000,
+                        help="Documents per collection for the end-to-end \
+                              benchmarks. Default: 5000")
+    parser.add_argument("--backend", type=str, choices=["numpy", "python"],
+                        default=None, help="Dictionary sampling backend. \
+                              Default: numpy if installed")
+    parser.add_argument("--compare", type=str, nargs=2, default=None,
+                        metavar=("OLD", "NEW"),
+                        help="Compare two result files instead of running.")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="Percentage by which a result must get worse to \
+                              count as a regression. Default: 10")
+    return parser.parse_args(argv)
+
+def measure(func, duration):
+    '''
+    Call `func` repeatedly for about `duration` seconds, in three rounds.
+    Returns the best round's calls per second.
+    :param func:
+    :param duration:
+    '''
+    best = 0.0
+    for attempt in range(3):
+        calls  = 0
+        number = 1
+        start  = time.perf_counter()
+        while True:
+            for i in range(number):
+                func()
+            calls   = calls + number
+            elapsed = time.perf_counter() - start
+            if elapsed >= duration / 3:
+                break
+            number = number * 2
+        best = max(best, calls / elapsed)
+    return best
+
+def missed_target(name, result):
+    '''
+    Return the target a result misses, or None if it meets it or has none.
+    :param name:
+    :param result:          {"value": ..., "unit": ...} dict.
+    '''
+    target = TARGETS.get(name)
+    if target is None:
+        return None
+    if result["unit"] in LOWER_BETTER:
+        missed = result["value"] > target
+    else:
+        missed = result["value"] < target
+    return target if missed else None
+
+def bench_dictionaries(registry, duration):
+    '''
+    Time generate_data() for each dictionary.
+    :param registry:        DictionaryRegistry.
+    :param duration:
+    '''
+    results = {}
+    rng     = streams.Stream(streams.derive_key(0))
+    for name, dictionary, options in DICTIONARY_CASES:
+        generate_data = registry[dictionary].generate_data
+        results[name] = (measure(lambda: generate_data(rng=rng, **options),
+                                 duration), "calls/s")
+    return results
+
+def bench_numbers(registry, duration):
+    '''
+    Time generate_batch() for each number type, a block of documents at a
+    time. Reports values per second.
+    :param registry:
+    :param duration:
+    '''
+    results = {}
+    rng     = streams.Stream(streams.derive_key(0))
+    batch   = registry["numbers"].generate_batch
+    for name, field_type, options in NUMBER_CASES:
+        calls = measure(lambda: batch(NUMBER_BATCH, rng=rng,
+                                      field_type=field_type, **options),
+                        duration)
+        results[name] = (calls * NUMBER_BATCH, "values/s")
+    return results
+
+def bench_distributions(registry, duration):
+    '''
+    Time generate_batch() on the words dictionary with each distribution, a
+    block of documents at a time. Reports words per second.
+    :param registry:
+    :param duration:
+    '''
+    results = {}
+    rng     = streams.Stream(streams.derive_key(0))
+    words   = registry["words"]
+    for name, spec in DISTRIBUTION_CASES:
+        table = distributions.compile_distribution(spec, words.population(),
+                                                   streams.derive_key(0),
+                                                   words.use_numpy)
+        calls = measure(lambda: words.generate_batch(NUMBER_BATCH,
+                                                     DISTRIBUTION_WORDS, rng,
+                                                     distribution=table),
+                        duration)
+        results[name] = (calls * NUMBER_BATCH * DISTRIBUTION_WORDS, "words/s")
+    return results
+
+def bench_grammars(registry, duration):
+    '''
+    Time each grammar function on lorem ipsum words.
+    :param registry:
+    :param duration:
+    '''
+    results = {}
+    rng     = streams.Stream(streams.derive_key(0))
+    for name, grammar, size in GRAMMAR_CASES:
+        data = registry["lipsum"].generate_data(size, rng)
+        results[name] = (measure(lambda: grammar(data, rng=rng), duration),
+                         "calls/s")
+    return results
+
+def bench_encoders(registry, duration):
+    '''
+    Time each encoder on a generated body, with a few non-ASCII characters so
+    no encoder can take its pure-ASCII shortcut.
+    :param registry:
+    :param duration:
+    '''
+    results = {}
+    rng     = streams.Stream(streams.derive_key(0))
+    text    = grammars.body(registry["lipsum"].generate_data(50, rng),
+                            rng=rng) + "café <naïve> & über"
+    for name in sorted(encoders.encoders):
+        encode = encoders.get_encoder(name).encode
+        results["encoder." + name] = (measure(lambda: encode(text), duration),
+                                      "calls/s")
+    return results
+
+def bench_end_to_end(registry, count):
+    '''
+    Generate the sample template with each engine into a NullInterface.
+    Reports documents and BSON megabytes per second.
+    :param registry:
+    :param count:           Documents per collection.
+    '''
+    with open(__sample__, "r") as fp:
+        template = json.load(fp)
+    for collection in template:
+        collection["count"] = count
+
+    results = {}
+    for engine in ("batch", "row"):
+        output = NullInterface()
+        gen    = generator.Generator(template, output, use_pbar=False,
+                                     preserve_database=False, engine=engine,
+                                     seed=0, dictionaries=registry)
+        with contextlib.redirect_stdout(io.StringIO()):
+            gen.compile()
+            start = time.perf_counter()
+            gen.run()
+            elapsed = time.perf_counter() - start
+        name = "end_to_end." + engine
+        results[name + ".docs"]  = (output.documents / elapsed, "docs/s")
+        results[name + ".bytes"] = (output.bytes_written / elapsed / 1e6,
+                                    "MB/s")
+    return results
+
+class LatencyInterface(NullInterface):
+    '''
+    A NullInterface that takes `latency` seconds per batch, standing in for
+    a server's round trip. It sleeps, which releases the GIL as waiting on a
+    socket does, so writer threads overlap their waits.
+    '''
+    thread_safe = True
+    def __init__(self, latency, batch_size=None):
+        import threading
+        NullInterface.__init__(self, batch_size)
+        self.latency = latency
+        self.lock    = threading.Lock()     # Guards the counters
+
+    def clone(self):
+        return LatencyInterface(self.latency, self.batch_size)
+
+    def write_many(self, collection, documents):
+        with self.lock:
+            ids = NullInterface.write_many(self, collection, documents)
+        time.sleep(self.latency)
+        return ids
+
+def bench_pipeline(registry, count):
+    '''
+    Generate the sample template into a LatencyInterface, writing serially
+    and with each number of writer threads in PIPELINE_WRITERS. Reports
+    documents per second.
+    :param registry:
+    :param count:           Documents per collection.
+    '''
+    with open(__sample__, "r") as fp:
+        template = json.load(fp)
+    for collection in template:
+        collection["count"] = count
+
+    results = {}
+    for writers in (0,) + PIPELINE_WRITERS:
+        sink   = LatencyInterface(PIPELINE_LATENCY, PIPELINE_BATCH)
+        output = sink
+        name   = "pipeline.serial"
+        if writers:
+            output = PipelinedInterface(sink, writers)
+            name   = "pipeline.writers.%d" % writers
+        gen = generator.Generator(template, output, use_pbar=False,
+                                  preserve_database=False, seed=0,
+                                  dictionaries=registry)
+        with contextlib.redirect_stdout(io.StringIO()):
+            gen.compile()
+            start = time.perf_counter()
+            gen.run()
+            elapsed = time.perf_counter() - start
+        results[name] = (sink.documents / elapsed, "docs/s")
+    return results
+
+def bench_idstore(count=IDSTORE_COUNT):
+    '''
+    Keep `count` new ObjectIds, a batch at a time, in a list and in an
+    IdStore. Reports the peak memory traced while each is filled.
+    :param count:
+    '''
+    import tracemalloc
+    from bson.objectid import ObjectId
+
+    results = {}
+    for name, store in (("idstore.list", []),
+                        ("idstore.packed", idstore.IdStore())):
+        tracemalloc.start()
+        for start in range(0, count, IDSTORE_BATCH):
+            store.extend([ObjectId() for i in
+                          range(min(IDSTORE_BATCH, count - start))])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del store
+        results[name] = (peak / 1e6, "MB")
+    return results
+
+def read_smaps():
+    '''
+    Return this process's (RSS, PSS, private dirty) memory, in bytes, from
+    /proc/self/smaps_rollup, or None where that is not available.
+    '''
+    fields = {}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as fp:
+            for line in fp:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    except OSError:
+        return None
+    return (fields.get("Rss", 0), fields.get("Pss", 0),
+            fields.get("Private_Dirty", 0))
+
+class SmapsInterface(NullInterface):
+    '''
+    A NullInterface that records the memory of the process writing to it
+    each time it finishes a collection, in a file named after the process
+    in `directory`.
+    '''
+    def __init__(self, directory, batch_size=None):
+        NullInterface.__init__(self, batch_size)
+        self.directory = directory
+
+    def clone(self):
+        return SmapsInterface(self.directory, self.batch_size)
+
+    def finish(self, collection):
+        memory = read_smaps()
+        if memory is not None:
+            path = os.path.join(self.directory, "%d.json" % os.getpid())
+            with open(path, "w") as fp:
+                json.dump(memory, fp)
+
+def bench_share_dictionaries(count):
+    '''
+    Generate the sample template on SHARE_WORKERS worker processes, with and
+    without --share-dictionaries. Reports each worker's RSS, PSS and private
+    dirty memory, averaged over the workers, once it has finished its last
+    shard. Linux only; elsewhere nothing is reported.
+    :param count:           Documents per collection.
+    '''
+    if read_smaps() is None:
+        return {}
+    with open(__sample__, "r") as fp:
+        template = json.load(fp)
+    for collection in template:
+        collection["count"] = count
+
+    results = {}
+    for name, share in (("share_dictionaries.off", False),
+                        ("share_dictionaries.on", True)):
+        directory = tempfile.mkdtemp()
+        try:
+            # Sharing moves the dictionaries, so each run loads its own.
+            with contextlib.redirect_stdout(io.StringIO()):
+                registry = dictionaries.DictionaryRegistry()
+                gen      = generator.Generator(
+                    template, SmapsInterface(directory), use_pbar=False,
+                    preserve_database=False, seed=0, dictionaries=registry,
+                    workers=SHARE_WORKERS, share_dictionaries=share)
+                gen.run()
+            readings = []
+            for filename in os.listdir(directory):
+                with open(os.path.join(directory, filename), "r") as fp:
+                    readings.append(json.load(fp))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        for index, key in enumerate(("rss", "pss", "private")):
+            results["%s.%s" % (name, key)] = (
+                sum([reading[index] for reading in readings]) /
+                len(readings) / 1e6, "MB")
+    return results
+
+def bench_text_pool(registry, count):
+    '''
+    Generate 500-word bodies into a NullInterface with and without a
+    text_pool. Reports documents per second.
+    :param registry:
+    :param count:           Documents per run.
+    '''
+    results = {}
+    for name, pool in (("text_pool.off", None), ("text_pool.on", 1000)):
+        template = json.loads(json.dumps(BODY_TEMPLATE))
+        template[0]["count"] = count
+        if pool is not None:
+            template[0]["fields"][0]["text_pool"] = pool
+        output = NullInterface()
+        gen    = generator.Generator(template, output, use_pbar=False,
+                                     preserve_database=False, seed=0,
+                                     dictionaries=registry)
+        with contextlib.redirect_stdout(io.StringIO()):
+            gen.compile()
+            start = time.perf_counter()
+            gen.run()
+            elapsed = time.perf_counter() - start
+        results[name + ".docs"] = (output.documents / elapsed, "docs/s")
+    return results
+
+def bench_cold_start(runs=5):
+    '''
+    Time the command line tool generating a numbers-only template in a new
+    interpreter. Reports the median of `runs` runs.
+    :param runs:
+    '''
+    fd, path = tempfile.mkstemp(suffix=".json")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            json.dump(COLD_TEMPLATE, fp)
+        command = [sys.executable, "-c",
+                   "from datagen.script import start; start()",
+                   "-t", "-n", path]
+        env  = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(
+            [root] + [p for p in [env.get("PYTHONPATH")] if p])
+        times = []
+        for i in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, stdout=subprocess.DEVNULL, env=env,
+                           check=True)
+            times.append(time.perf_counter() - start)
+    finally:
+        os.unlink(path)
+    times.sort()
+    return {"cold_start": (times[len(times) // 2], "s")}
+
+def run(args):
+    '''
+    Run every benchmark and return the results document.
+    :param args:
+    '''
+    use_numpy = None if args.backend is None else args.backend == "numpy"
+    with contextlib.redirect_stdout(io.StringIO()):
+        registry = dictionaries.DictionaryRegistry(use_numpy=use_numpy)
+        for name in registry.dictionaries:
+            registry[name]
+
+    results = {}
+    for suite in (lambda: bench_dictionaries(registry, args.duration),
+                  lambda: bench_numbers(registry, args.duration),
+                  lambda: bench_distributions(registry, args.duration),
+                  lambda: bench_grammars(registry, args.duration),
+                  lambda: bench_encoders(registry, args.duration),
+                  lambda: bench_end_to_end(registry, args.count),
+                  lambda: bench_text_pool(registry, args.count),
+                  lambda: bench_pipeline(registry, args.count),
+                  bench_idstore,
+                  lambda: bench_share_dictionaries(args.count),
+                  bench_cold_start):
+        for name, (value, unit) in sorted(suite().items()):
+            results[name] = {"value": value, "unit": unit}
+            target = missed_target(name, results[name])
+            sys.stderr.write("%-28s %12.2f %s%s\n" %
+                             (name, value, unit, "" if target is None else
+                              "  MISSED TARGET (%g %s)" % (target, unit)))
+
+    from datagen import script
+    return {
+        "datagen":  script.__version__,
+        "python":   platform.python_version(),
+        "backend":  "numpy" if registry["words"].use_numpy else "python",
+        "time":     time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results":  results
+    }
+
+def compare(old, new, threshold):
+    '''
+    Print each result of two runs side by side. Returns the names of results
+    that got worse by more than `threshold` percent, or that miss their
+    target in the new run.
+    :param old:             Results document of the earlier run.
+    :param new:
+    :param threshold:
+    '''
+    regressions = []
+    print("%-28s %12s %12s %9s" % ("benchmark", "old", "new", "change"))
+    for name in sorted(set(old["results"]) & set(new["results"])):
+        before = old["results"][name]
+        after  = new["results"][name]
+        if not before["value"]:
+            continue
+        change = (after["value"] - before["value"]) / before["value"] * 100
+        worse  = -change if after["unit"] in LOWER_BETTER else change
+        flag   = ""
+        if worse < -threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif missed_target(name, after) is not None:
+            flag = "  MISSED TARGET"
+            regressions.append(name)
+        print("%-28s %12.2f %12.2f %+8.1f%%%s" % (name, before["value"],
+                                                  after["value"], change,
+                                                  flag))
+    for name in sorted(set(old["results"]) ^ set(new["results"])):
+        print("%-28s only in %s" % (name, "old" if name in old["results"]
+                                    else "new"))
+    return regressions
+
+def main(argv):
+    '''
+    Entry point for `datagen bench`. Returns the exit status: 1 if a compare
+    found regressions or a result missed its target, else 0.
+    :param argv:            Arguments after "bench".
+    '''
+    args = parse_args(argv)
+
+    if args.compare:
+        documents = []
+        for path in args.compare:
+            try:
+                with open(path, "r") as fp:
+                    documents.append(json.load(fp))
+            except (OSError, ValueError) as exc:
+                raise Exception("Could not read results file '%s': %s" %
+                                (path, str(exc)))
+        regressions = compare(documents[0], documents[1], args.threshold)
+        if regressions:
+            print("\n%d regression(s) beyond %.1f%%." % (len(regressions),
+                                                        args.threshold))
+            return 1
+        return 0
+
+    document = run(args)
+    results  = json.dumps(document, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(results + "\n")
+    else:
+        print(results)
+    missed = [name for name, result in sorted(document["results"].items())
+              if missed_target(name, result) is not None]
+    if missed:
+        sys.stderr.write("\n%d result(s) missed their target: %s\n" %
+                         (len(missed), ", ".join(missed)))
+        return 1
+    return 0
@@ -0,0 +1,255 @@
+'''
+cache.py
+
+Compiled dictionary cache.
+
+Parsing the dictionary source files is slow compared to the rest of startup,
+so the parsed word lists are cached in a binary file, keyed by a hash of the
+source file:
+
+    magic     4 bytes   b"DGC1"
+    count     8 bytes   number of entries, little-endian
+    offsets   8 bytes * (count + 1), little-endian, into the blob
+    blob      UTF-8 entries, each followed by a NUL byte
+
+Entry i is blob[offsets[i]:offsets[i + 1] - 1]. A whole table can also be
+decoded in one call by splitting the blob on NUL.
+
+The same format backs PackedTable, which reads entries straight out of a
+buffer. share() places a table in shared memory, so worker processes forked
+from the parent sample one copy of it instead of each holding their own.
+
+The cache lives in $DATAGEN_CACHE_DIR, or ~/.cache/datagen by default. Setting
+DATAGEN_CACHE_DIR to an empty string disables it.
+'''
+from array import array
+import hashlib
+import mmap
+import os
+import sys
+
+from datagen import streams
+
+MAGIC   = b"DGC1"
+VERSION = b"1"
+
+def cache_dir():
+    '''
+    Return the cache directory, or None if caching is disabled.
+    '''
+    path = os.environ.get("DATAGEN_CACHE_DIR")
+    if path is None:
+        base = os.environ.get("XDG_CACHE_HOME",
+                              os.path.join(os.path.expanduser("~"), ".cache"))
+        path = os.path.join(base, "datagen")
+    return path or None
+
+def cache_path(source, tag):
+    '''
+    Return the cache file path for a source file, or None if caching is
+    disabled.
+    :param source:          Path of the source file.
+    :param tag:             Distinguishes caches built from the same source by
+                            different parsers.
+    '''
+    directory = cache_dir()
+    if directory is None:
+        return None
+    digest = hashlib.sha1(VERSION + b"\0" + tag.encode("utf-8") + b"\0")
+    with open(source, "rb") as fp:
+        digest.update(fp.read())
+    name = "%s-%s.dgc" % (os.path.basename(source), digest.hexdigest())
+    return os.path.join(directory, name)
+
+def pack(entries):
+    '''
+    Pack a list of strings into the cache format.
+    :param entries:
+    '''
+    text = "".join([entry + "\0" for entry in entries])
+    if text.count("\0") != len(entries):
+        raise ValueError("Dictionary entries cannot contain NUL")
+    blob    = text.encode("utf-8")
+    offsets = array("Q", [0])
+    pos     = 0
+    for entry in entries:
+        pos = pos + len(entry.encode("utf-8")) + 1
+        offsets.append(pos)
+    if sys.byteorder != "little":
+        offsets.byteswap()
+    return b"".join([MAGIC, len(entries).to_bytes(8, "little"),
+                     offsets.tobytes(), blob])
+
+def read_offsets(data):
+    '''
+    Return (offsets, blob start) for packed cache data.
+    :param data:            bytes, or any buffer such as an mmap.
+    '''
+    if bytes(data[:4]) != MAGIC:
+        raise ValueError("Not a datagen dictionary cache")
+    count   = int.from_bytes(data[4:12], "little")
+    start   = 12 + 8 * (count + 1)
+    offsets = array("Q")
+    offsets.frombytes(data[12:start])
+    if sys.byteorder != "little":
+        offsets.byteswap()
+    if len(offsets) != count + 1 or len(data) != start + offsets[-1]:
+        raise ValueError("Truncated datagen dictionary cache")
+    return offsets, start
+
+def unpack(data):
+    '''
+    Unpack cache data into a list of strings.
+    :param data:
+    '''
+    if bytes(data[:4]) != MAGIC:
+        raise ValueError("Not a datagen dictionary cache")
+    count = int.from_bytes(data[4:12], "little")
+    start = 12 + 8 * (count + 1)
+    if len(data) < start or \
+            len(data) != start + int.from_bytes(data[start - 8:start],
+                                                "little"):
+        raise ValueError("Truncated datagen dictionary cache")
+    if count == 0:
+        return []
+    entries = data[start:-1].decode("utf-8").split("\0")
+    if len(entries) != count:
+        raise ValueError("Corrupt datagen dictionary cache")
+    return entries
+
+class PackedTable(object):
+    '''
+    A read-only table of strings in the cache format, read in place from a
+    buffer. Entries are decoded only when they are taken.
+    '''
+    def __init__(self, buffer):
+        '''
+        :param buffer:          bytes, mmap or any other buffer holding packed
+                                cache data.
+        '''
+        self.buffer = buffer
+        view        = memoryview(buffer)
+        offsets, start = read_offsets(view)
+        if sys.byteorder == "little":
+            # Read the offsets in place rather than keep the copy.
+            offsets = view[12:start].cast("Q")
+        self.offsets = offsets
+        self.blob    = view[start:]
+        self.start   = start
+        self.count   = len(offsets) - 1
+        self.arrays  = None     # NumPy views of (offsets, blob), on first use
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = index + self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("table index out of range")
+        return str(self.blob[self.offsets[index]:self.offsets[index + 1] - 1],
+                   "utf-8")
+
+    def take(self, indices):
+        '''
+        Return the entries at a sequence of indices. The picked entries are
+        joined and decoded in one call.
+        :param indices:
+        '''
+        if not len(indices):
+            return []
+        if not isinstance(indices, (list, tuple, range)):
+            return self.take_array(indices)
+        # Slicing an mmap or bytes buffer directly is cheaper than slicing
+        # the memoryview.
+        buffer  = self.buffer
+        offsets = self.offsets
+        start   = self.start
+        return b"\0".join([buffer[start + offsets[i]:
+                                  start + offsets[i + 1] - 1]
+                           for i in indices]).decode("utf-8").split("\0")
+
+    def take_array(self, indices):
+        '''
+        take() for a NumPy array of indices. The picked entries, with their
+        NUL terminators, are gathered from the blob in one vectorized step.
+        :param indices:
+        '''
+        numpy = streams.get_numpy()
+        if self.arrays is None:
+            self.arrays = (numpy.frombuffer(self.buffer, dtype="<i8",
+                                            count=self.count + 1, offset=12),
+                           numpy.frombuffer(self.buffer, dtype=numpy.uint8,
+                                            offset=self.start))
+        offsets, blob = self.arrays
+        starts  = offsets[indices]
+        lengths = offsets[indices + 1] - starts
+        # Position of every gathered byte in the blob: its position in the
+        # output, shifted by where its entry starts in each.
+        shift   = numpy.repeat(starts - (numpy.cumsum(lengths) - lengths),
+                               lengths)
+        data    = blob[numpy.arange(len(shift)) + shift].tobytes()
+        return data[:-1].decode("utf-8").split("\0")
+
+def share(entries):
+    '''
+    Pack a list of strings into anonymous shared memory and return a
+    PackedTable over it. The memory is inherited by processes forked after
+    this call, which read the parent's pages rather than copies.
+    :param entries:
+    '''
+    data   = pack(entries)
+    shared = mmap.mmap(-1, len(data))
+    shared.write(data)
+    return PackedTable(shared)
+
+def load(source, parse, tag=""):
+    '''
+    Return the entries parsed from a source file, from the cache if it has
+    them, as an (entries, cached) tuple. On a miss, `parse` is called and its
+    result cached.
+    :param source:          Path of the source file.
+    :param parse:           Callable returning a list of strings.
+    :param tag:
+    '''
+    try:
+        path = cache_path(source, tag)
+    except OSError:
+        path = None
+    if path is not None:
+        try:
+            with open(path, "rb") as fp:
+                return unpack(fp.read()), True
+        except (OSError, ValueError, UnicodeDecodeError):
+            pass
+
+    entries = parse()
+    if path is not None:
+        store(path, entries)
+    return entries, False
+
+def store(path, entries):
+    '''
+    Write a cache file. The file is written to a temporary name and moved into
+    place, so readers never see a partial file. Failures are ignored; the cache
+    is only an optimization.
+    :param path:
+    :param entries:
+    '''
+    try:
+        data = pack(entries)
+    except ValueError:
+        return
+    import tempfile
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except (OSError, NameError):
+            pass
@@ -0,0 +1,348 @@
+'''
+checkpoint.py
+
+Checkpoints for resumable runs.
+
+A run with a checkpoint directory records, for every collection, the ranges
+of documents it is split into and how far each range has been written: up
+to the last batch the output has acknowledged. Documents are a pure function
+of the seed, the template and their position in the collection, so those
+positions are all a resumed run needs to carry on where the last one
+stopped, without generating or writing anything twice. The ids of
+referenced collections are appended to a spill file per range as their
+batches are written, so references can still be drawn after a restart. A
+size-targeted collection also records the estimated size of what it has
+written, so its estimate carries on where it stopped.
+
+Each collection's positions live in a small file mapped into memory, shared
+with forked workers. Whichever process writes a range advances its position
+once the batch is acknowledged and its ids are spilled, so both are in the
+operating system's hands as soon as the batch is done and survive the
+process dying. Every `interval` seconds, and whenever a collection finishes,
+the main process syncs them to disk and replaces state.json, which holds
+the ranges and which collections are finished.
+'''
+import collections
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import time
+
+from datagen import idstore
+
+VERSION = 2
+STATE   = "state.json"
+
+def fingerprint(template):
+    '''
+    Return a hash of a template, to tell whether a checkpoint was made with
+    it.
+    :param template:
+    '''
+    data = json.dumps(template, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def saved_seed(directory):
+    '''
+    Return the seed of the run checkpointed in `directory`.
+    :param directory:
+    '''
+    return read_state(directory)["settings"]["seed"]
+
+def read_state(directory):
+    '''
+    Read a checkpoint's state.json.
+    :param directory:
+    '''
+    path = os.path.join(directory, STATE)
+    try:
+        with open(path) as fp:
+            state = json.load(fp)
+    except OSError:
+        raise Exception("No checkpoint to resume in '%s'." % directory)
+    except ValueError as exc:
+        raise Exception("Checkpoint '%s' could not be parsed: %s" %
+                        (path, str(exc)))
+    if state.get("version") != VERSION:
+        raise Exception("Checkpoint '%s' was written by an incompatible \
+                         version of datagen." % path)
+    return state
+
+def open_checkpoint(directory, settings, resume=False, interval=30.0,
+                    started=None):
+    '''
+    Return a Checkpoint recording a run in `directory`. When resuming, the
+    saved progress and start time are loaded, and the run must have the
+    settings it was saved with.
+    :param directory:
+    :param settings:        Dict of the settings that decide what a run
+                            generates: seed, template fingerprint, engine,
+                            encoding and backend.
+    :param resume:
+    :param interval:        Seconds between saves.
+    :param started:         Time the run started, in whole seconds. Ids
+                            made client-side depend on it.
+    '''
+    checkpoint = Checkpoint(directory, settings, interval, started)
+    if resume:
+        state = read_state(directory)
+        for key, value in sorted(state["settings"].items()):
+            if settings.get(key) != value:
+                raise Exception("Cannot resume from checkpoint '%s': it was \
+                                 made with a different %s (%r, not %r)." %
+                                (directory, key, value, settings.get(key)))
+        checkpoint.collections = state["collections"]
+        checkpoint.started     = state["started"]
+    else:
+        # Replace any earlier run's state straight away: its documents are
+        # about to be cleared.
+        checkpoint.save()
+    return checkpoint
+
+class RangeLog(object):
+    '''
+    Records the batches written in one range of a collection.
+    '''
+    def __init__(self, positions, slot, path=None):
+        '''
+        :param positions:       Shared array of the collection's positions,
+                                followed by its estimated size.
+        :param slot:            The range's index in it.
+        :param path:            Spill file for the written ids, or None if
+                                they are not kept.
+        '''
+        self.positions = positions
+        self.slot      = slot
+        self.path      = path
+        self.fp        = None
+        self.sizes     = collections.deque()    # Sizes of unwritten documents
+
+    def expect(self, sizes):
+        '''
+        Queue the estimated sizes of documents about to be written, in
+        order. Each batch recorded by add() adds its documents' sizes to the
+        collection's.
+        :param sizes:
+        '''
+        self.sizes.extend(sizes)
+
+    def add(self, ids):
+        '''
+        Record a written batch: spill its ids, then advance the position.
+        :param ids:             Ids of the batch's documents.
+        '''
+        if not ids:
+            return
+        if self.path is not None:
+            if self.fp is None:
+                self.fp = open(self.path, "ab")
+            pickle.dump(list(ids), self.fp, pickle.HIGHEST_PROTOCOL)
+            self.fp.flush()
+        if self.sizes:
+            popleft = self.sizes.popleft
+            self.positions[len(self.positions) - 1] += sum(
+                [popleft() for i in range(len(ids))])
+        self.positions[self.slot] += len(ids)
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+class Checkpoint(object):
+    '''
+    The progress of a run, saved in a directory.
+
+    Each collection is recorded as {"ranges": [[start, stop, written], ...],
+    "size": int, "done": bool}, where documents [start, written) of each
+    range are written, and "size" is the estimated size of a size-targeted
+    collection's written documents. A size-targeted collection has a single
+    range, whose stop is None.
+    '''
+    def __init__(self, directory, settings, interval=30.0, started=None):
+        '''
+        :param directory:       Created if missing.
+        :param settings:
+        :param interval:
+        :param started:
+        '''
+        self.directory   = directory
+        self.settings    = settings
+        self.interval    = interval
+        self.started     = started
+        self.collections = {}
+        self.positions   = {}   # Shared positions of running collections
+        self.saved       = time.time()
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as exc:
+            raise Exception("Checkpoint directory '%s' could not be created: \
+                             %s" % (directory, str(exc)))
+
+    def positions_path(self, name):
+        '''
+        Return the path of a collection's positions file.
+        :param name:
+        '''
+        return os.path.join(self.directory, "%s.positions" % name)
+
+    def spill_path(self, name, index):
+        '''
+        Return the path of the id spill file of a collection's range.
+        :param name:
+        :param index:
+        '''
+        return os.path.join(self.directory, "%s.%d.ids" % (name, index))
+
+    def is_done(self, name):
+        '''
+        Return True if a collection was finished.
+        :param name:
+        '''
+        return self.collections.get(name, {}).get("done", False)
+
+    def ranges(self, name, ranges):
+        '''
+        Start recording a collection. A collection the checkpoint has not
+        seen is split into `ranges`, (start, stop) pairs; one it has keeps
+        its saved ranges, written up to the positions in its positions file.
+        Returns the collection's (start, stop, written) ranges.
+        :param name:
+        :param ranges:
+        '''
+        state = self.collections.get(name)
+        path  = self.positions_path(name)
+        if state is None:
+            state = {"ranges": [[start, stop, start] for start, stop in ranges],
+                     "size": 0, "done": False}
+            self.collections[name] = state
+            for index in range(len(ranges)):
+                if os.path.exists(self.spill_path(name, index)):
+                    os.unlink(self.spill_path(name, index))
+        elif os.path.exists(path):
+            # The positions file is at least as recent as the state.
+            with open(path, "rb") as fp:
+                data = fp.read()
+            if len(data) == 8 * (len(state["ranges"]) + 1):
+                data = memoryview(data).cast("q")
+                for index, item in enumerate(state["ranges"]):
+                    item[2] = max(item[2], data[index])
+                state["size"] = max(state.get("size", 0), data[-1])
+
+        values = [item[2] for item in state["ranges"]] + [state.get("size", 0)]
+        with open(path, "w+b") as fp:
+            fp.write(bytes(8 * len(values)))
+            fp.flush()
+            memory = mmap.mmap(fp.fileno(), 8 * len(values))
+        positions = memoryview(memory).cast("q")
+        for index, value in enumerate(values):
+            positions[index] = value
+        self.positions[name] = (memory, positions)
+        # The ranges are saved before anything is written in them.
+        self.save()
+        return [tuple(item) for item in state["ranges"]]
+
+    def log(self, name, index, keep_ids=False):
+        '''
+        Return a RangeLog for a range of a running collection.
+        :param name:
+        :param index:
+        :param keep_ids:        Spill the range's ids.
+        '''
+        return RangeLog(self.positions[name][1], index,
+                        self.spill_path(name, index) if keep_ids else None)
+
+    def size(self, name):
+        '''
+        Return the estimated size of a collection's written documents.
+        :param name:
+        '''
+        return self.collections[name].get("size", 0)
+
+    def load_ids(self, name, index, count):
+        '''
+        Return an IdStore of the first `count` ids spilled for a range, and
+        cut the spill file after them, dropping ids written after the last
+        save.
+        :param name:
+        :param index:
+        :param count:
+        '''
+        ids  = idstore.IdStore()
+        path = self.spill_path(name, index)
+        if not count:
+            if os.path.exists(path):
+                os.unlink(path)
+            return ids
+        try:
+            with open(path, "r+b") as fp:
+                while len(ids) < count:
+                    ids.extend(pickle.load(fp))
+                fp.truncate(fp.tell())
+        except (OSError, EOFError, pickle.UnpicklingError) as exc:
+            raise Exception("Ids of collection '%s' could not be read from \
+                             checkpoint file '%s': %s" %
+                            (name, path, str(exc)))
+        if len(ids) != count:
+            raise Exception("Checkpoint file '%s' does not end on a batch \
+                             boundary." % path)
+        return ids
+
+    def finish(self, name):
+        '''
+        Mark a collection finished and save.
+        :param name:
+        '''
+        self.sync(name)
+        memory, positions = self.positions.pop(name)
+        positions.release()
+        memory.close()
+        self.collections[name]["done"] = True
+        self.save()
+
+    def sync(self, name):
+        '''
+        Copy a running collection's positions into its state.
+        :param name:
+        '''
+        memory, positions = self.positions[name]
+        state = self.collections[name]
+        for index, item in enumerate(state["ranges"]):
+            item[2] = positions[index]
+        state["size"] = positions[len(positions) - 1]
+
+    def poll(self):
+        '''
+        Save if `interval` seconds have passed since the last save.
+        '''
+        if time.time() - self.saved >= self.interval:
+            self.save()
+
+    def save(self):
+        '''
+        Sync the spill and positions files, then write the state to
+        state.json.
+        '''
+        for name in self.positions:
+            self.sync(name)
+            for index in range(len(self.collections[name]["ranges"])):
+                path = self.spill_path(name, index)
+                if os.path.exists(path):
+                    fd = os.open(path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            self.positions[name][0].flush()
+        path = os.path.join(self.directory, STATE)
+        with open(path + ".tmp", "w") as fp:
+            json.dump({"version":     VERSION,
+                       "settings":    self.settings,
+                       "started":     self.started,
+                       "collections": self.collections}, fp, sort_keys=True)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(path + ".tmp", path)
+        self.saved = time.time()
@@ -0,0 +1,576 @@
+'''
+compiler.py
+
+Template compiler. Each collection definition is validated and compiled once
+into a CollectionPlan: a flat list of fields, each bound to the callables that
+produce its values. The document engines only run the plan.
+'''
+import time
+
+from datagen import distributions
+from datagen import grammars
+from datagen import idstore
+from datagen import sizing
+from datagen import streams
+from datagen import textpool
+
+class FieldPlan(object):
+    '''
+    A compiled field.
+    '''
+    def __init__(self, name, value, column, reference=None):
+        '''
+        :param name:            Field key.
+        :param value:           Callable, value(rng), returning one value.
+        :param column:          Callable, column(count, rng), returning a list
+                                of `count` values.
+        :param reference:       Name of the collection the field refers to.
+        '''
+        self.name      = name
+        self.value     = value
+        self.column    = column
+        self.reference = reference
+
+class CollectionPlan(object):
+    '''
+    A compiled collection definition.
+    '''
+    def __init__(self, name, count, fields, definition, id_strategy=None,
+                 target_size=None):
+        '''
+        :param name:            Collection name.
+        :param count:           Number of documents to generate. None for a
+                                size-targeted collection until it is written.
+        :param fields:          List of FieldPlan objects.
+        :param definition:      The collection's template definition.
+        :param id_strategy:     Optional IdStrategy assigning document ids.
+        :param target_size:     Optional BSON size, in bytes, to generate
+                                documents up to instead of a count.
+        '''
+        self.name         = name
+        self.count        = count
+        self.target_size  = target_size
+        self.fields       = fields
+        self.definition   = definition
+        self.id_strategy  = id_strategy
+        self.dependencies = set()   # Collections to generate before this one
+
+    @property
+    def references(self):
+        '''
+        Names of the collections this collection refers to.
+        '''
+        return [field.reference for field in self.fields if field.reference]
+
+def compile_template(generator, template):
+    '''
+    Validate and compile every collection in a template. Returns a list of
+    CollectionPlan objects in dependency order: every collection comes after
+    the collections whose ids it refers to, and otherwise in template order.
+    :param generator:       Generator that will run the plans.
+    :param template:
+    '''
+    if not isinstance(template, list):
+        raise Exception("Template must be a JSON list of collection \
+                         definitions.")
+
+    # Collections may refer to collections defined after them, so every
+    # collection is declared before any fields are compiled.
+    plans   = []
+    defined = {}
+    for collection in template:
+        plan = compile_collection(generator, collection)
+        if plan.name in defined:
+            raise Exception("Collection '%s' is defined more than once." %
+                            plan.name)
+        defined[plan.name] = plan
+        plans.append(plan)
+
+    for plan in plans:
+        compile_fields(generator, plan, defined)
+    return order_plans(plans, defined)
+
+def compile_collection(generator, collection):
+    '''
+    Validate a single collection definition. Returns a CollectionPlan whose
+    fields are compiled later, by compile_fields().
+    :param generator:
+    :param collection:
+    '''
+    if not isinstance(collection, dict) or "collection_name" not in collection:
+        raise Exception("Every collection definition must be an object with \
+                         a 'collection_name'.")
+    name = collection["collection_name"]
+
+    # A collection is either counted or generated up to a size.
+    count  = None
+    target = None
+    if "target_size" in collection:
+        if "count" in collection:
+            raise Exception("Collection '%s' has both a 'count' and a \
+                             'target_size'." % name)
+        target = sizing.parse_size(collection["target_size"])
+        if target is None or target <= 0:
+            raise Exception("Collection '%s' has an invalid target_size %r. \
+                             Sizes are a positive number of bytes or a string \
+                             such as '500GB'." %
+                            (name, collection["target_size"]))
+    else:
+        try:
+            count = int(collection["count"])
+        except (KeyError, TypeError, ValueError):
+            raise Exception("Collection '%s' must have an integer 'count' or \
+                             a 'target_size'." % name)
+        if count < 0:
+            raise Exception("Collection '%s' has a negative count." % name)
+
+    if not isinstance(collection.get("fields"), list):
+        raise Exception("Collection '%s' must have a list of 'fields'." % name)
+
+    id_strategy = None
+    if "id_strategy" in collection:
+        id_strategy = idstore.get_strategy(collection["id_strategy"], name,
+                                           count, generator.seed,
+                                           generator.started)
+    return CollectionPlan(name, count, [], collection, id_strategy, target)
+
+def compile_fields(generator, plan, defined):
+    '''
+    Validate and compile a collection's fields, and record the collections
+    it depends on. A reference only waits for its target when the target's
+    ids are assigned as it is written, or its size is only known then; ids
+    from an id strategy are known up front.
+    :param generator:
+    :param plan:
+    :param defined:         Dictionary of every CollectionPlan, by name.
+    '''
+    for field in plan.definition["fields"]:
+        if not isinstance(field, dict) or "name" not in field:
+            raise Exception("Every field in collection '%s' must be an object \
+                             with a 'name'." % plan.name)
+        if field["name"] == "_id" and plan.id_strategy is not None:
+            raise Exception("Collection '%s' has an id_strategy and an '_id' \
+                             field." % plan.name)
+        plan.fields.append(compile_field(generator, field, defined,
+                                         plan.name))
+    plan.dependencies = set([name for name in plan.references
+                             if defined[name].id_strategy is None or
+                             defined[name].target_size is not None])
+
+def order_plans(plans, defined):
+    '''
+    Sort plans so that each comes after its dependencies, keeping template
+    order where there is a choice. Raises if the dependencies form a cycle.
+    :param plans:
+    :param defined:
+    '''
+    ordered = []
+    done    = set()
+    waiting = list(plans)
+    while waiting:
+        for plan in waiting:
+            if plan.dependencies <= done:
+                break
+        else:
+            raise Exception("Collections refer to each other in a cycle: %s. \
+                             Give a collection in the cycle an id_strategy \
+                             so its ids are known before it is generated." %
+                            " -> ".join(find_cycle(waiting, defined)))
+        waiting.remove(plan)
+        done.add(plan.name)
+        ordered.append(plan)
+    return ordered
+
+def find_cycle(plans, defined):
+    '''
+    Return the names along one dependency cycle among plans that could not
+    be ordered, starting and ending with the same collection.
+    :param plans:
+    :param defined:
+    '''
+    # Every plan left waiting has a dependency that is also waiting, so
+    # following dependencies from any of them must revisit a collection.
+    waiting = set([plan.name for plan in plans])
+    path    = [plans[0].name]
+    while path.count(path[-1]) < 2:
+        path.append(sorted(defined[path[-1]].dependencies & waiting)[0])
+    return path[path.index(path[-1]):]
+
+def compile_field(generator, field, defined, collection=None):
+    '''
+    Validate and compile a single field definition.
+    :param generator:
+    :param field:
+    :param defined:
+    :param collection:      Name of the collection the field belongs to.
+    '''
+    if "generator" not in field:
+        plan = compile_reference(generator, field, defined)
+        if generator.profiler is not None:
+            plan = profile_reference(plan, generator.profiler.field(
+                collection, plan.name))
+        return plan
+
+    try:
+        gen = generator.dbs[field["generator"]]
+    except KeyError:
+        raise Exception("Invalid generator '%s' specified" %
+                        field["generator"])
+
+    options = dict(field.get("generator_options", {}))
+    options["field_type"] = field.get("type", "words")
+    options["size"]       = compile_size(field)
+    try:
+        gen.check_options(**options)
+    except Exception as exc:
+        raise Exception("Field '%s': %s" % (field["name"], str(exc)))
+    if "distribution" in field:
+        options["distribution"] = compile_distribution(
+            generator, field, field["generator"], gen.population(),
+            gen.use_numpy)
+
+    if "text_pool" in field:
+        return compile_text_pool(generator, field, gen, options, collection)
+
+    grammar = compile_grammar(field)
+    encoder = generator.encoder
+    generate_data  = gen.generate_data
+    generate_batch = gen.generate_batch
+
+    if generator.profiler is not None:
+        return profile_field(field["name"], gen, options, grammar, encoder,
+                             generator.profiler.field(collection,
+                                                      field["name"]))
+
+    if encoder.identity:
+        def value(rng):
+            return grammar(generate_data(rng=rng, **options), rng)
+    else:
+        encode = encoder.encode_value
+        def value(rng):
+            return encode(grammar(generate_data(rng=rng, **options), rng))
+
+    def column(count, rng):
+        return encoder.encode_column([grammar(data, rng) for data in
+                                      generate_batch(count, rng=rng,
+                                                     **options)])
+
+    return FieldPlan(field["name"], value, column)
+
+def compile_text_pool(generator, field, gen, options, collection):
+    '''
+    Compile a text field that draws its values from a textpool.TextPool.
+    When profiling, building pools is timed as the generate stage and
+    assembling text from them as the grammar stage.
+    :param generator:
+    :param field:
+    :param gen:             Dictionary generating the field.
+    :param options:         Options for the dictionary.
+    :param collection:
+    '''
+    name   = field["name"]
+    config = field["text_pool"]
+    if not isinstance(config, dict):
+        config = {"entries": config}
+    entries = config.get("entries", textpool.ENTRIES)
+    refresh = config.get("refresh", textpool.REFRESH)
+    for value in (entries, refresh):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            raise Exception("Field '%s' has an invalid text_pool. Give a \
+                             number of entries, or an object with \
+                             'entries' and 'refresh' counts." % name)
+    if field["generator"] not in ("words", "lipsum") or \
+            options["field_type"] not in ("body", "sentence", "headline",
+                                          "words"):
+        raise Exception("Field '%s': text_pool only works for words and \
+                         lipsum fields of type body, sentence, headline or \
+                         words." % name)
+
+    # A body's pool holds sentences, which are laid out in paragraphs.
+    paragraphs = options["field_type"] == "body"
+    if paragraphs:
+        grammar = lambda data, rng: grammars.sentence(data, rng=rng)
+    else:
+        grammar = compile_grammar(field)
+    pool    = textpool.TextPool(generator.seed, collection, name, gen,
+                                grammar, paragraphs, entries, refresh,
+                                options.get("distribution"))
+    encoder = generator.encoder
+    size    = options["size"]
+
+    if generator.profiler is not None:
+        clock = time.perf_counter
+        times = generator.profiler.field(collection, name)
+        def column(count, rng):
+            start = clock()
+            pool.pool(rng)
+            done  = clock()
+            times[0] += done - start
+            data  = pool.render(gen.pick_sizes(count, size, rng), rng)
+            start = clock()
+            times[1] += start - done
+            data  = encoder.encode_column(data)
+            times[2] += clock() - start
+            return data
+    else:
+        def column(count, rng):
+            return encoder.encode_column(pool.render(gen.pick_sizes(count,
+                                                                    size, rng),
+                                                     rng))
+
+    def value(rng):
+        return column(1, rng)[0]
+
+    return FieldPlan(name, value, column)
+
+def profile_field(name, gen, options, grammar, encoder, times):
+    '''
+    Compile a generated field whose generate, grammar and encode stages are
+    timed separately, adding to `times`.
+    :param name:            Field key.
+    :param gen:             Dictionary generating the field.
+    :param options:         Options for the dictionary.
+    :param grammar:
+    :param encoder:
+    :param times:           List of seconds per profiler stage.
+    '''
+    clock          = time.perf_counter
+    generate_data  = gen.generate_data
+    generate_batch = gen.generate_batch
+    encode         = encoder.encode_value
+
+    def value(rng):
+        start = clock()
+        data  = generate_data(rng=rng, **options)
+        done  = clock()
+        times[0] += done - start
+        data  = grammar(data, rng)
+        start = clock()
+        times[1] += start - done
+        data  = encode(data)
+        times[2] += clock() - start
+        return data
+
+    def column(count, rng):
+        start = clock()
+        data  = generate_batch(count, rng=rng, **options)
+        done  = clock()
+        times[0] += done - start
+        data  = [grammar(item, rng) for item in data]
+        start = clock()
+        times[1] += start - done
+        data  = encoder.encode_column(data)
+        times[2] += clock() - start
+        return data
+
+    return FieldPlan(name, value, column)
+
+def profile_reference(plan, times):
+    '''
+    Wrap a compiled reference field so picking ids is timed as its generate
+    stage.
+    :param plan:            FieldPlan of the reference.
+    :param times:
+    '''
+    clock       = time.perf_counter
+    plan_value  = plan.value
+    plan_column = plan.column
+
+    def value(rng):
+        start = clock()
+        data  = plan_value(rng)
+        times[0] += clock() - start
+        return data
+
+    def column(count, rng):
+        start = clock()
+        data  = plan_column(count, rng)
+        times[0] += clock() - start
+        return data
+
+    return FieldPlan(plan.name, value, column, plan.reference)
+
+def compile_reference(generator, field, defined):
+    '''
+    Compile a "ref:<collection>" field. The referenced collection's ids are
+    looked up when values are generated.
+    :param generator:
+    :param field:
+    :param defined:
+    '''
+    field_type = field.get("type", "")
+    if not field_type.startswith("ref:"):
+        raise Exception("Field '%s' has no generator and is not a reference \
+                         ('ref:<collection>')." % field["name"])
+
+    ref_coll = field_type.split(":", 1)[1]
+    if ref_coll not in defined:
+        raise Exception("Field with name '%s' requests \
+                         reference to collection '%s' which \
+                         does not exist." % (field["name"], ref_coll))
+    if defined[ref_coll].count == 0:
+        raise Exception("Field with name '%s' requests reference to \
+                         collection '%s' which has no documents." %
+                        (field["name"], ref_coll))
+    if defined[ref_coll].target_size is not None and \
+            ("distribution" in field or "size" in field):
+        raise Exception("Field '%s': collection '%s' has a target_size, so \
+                         its documents are only counted once it is written. \
+                         A reference with a distribution or a size needs a \
+                         collection with a count." % (field["name"], ref_coll))
+
+    from bson.dbref import DBRef
+
+    ids      = generator.ids
+    dbname   = generator.dbname
+    strategy = defined[ref_coll].id_strategy
+    table    = None
+    if "distribution" in field:
+        table = compile_distribution(generator, field, "ref:" + ref_coll,
+                                     defined[ref_coll].count)
+
+    def take(indices):
+        if strategy is not None:
+            return strategy.take(indices)
+        return ids[ref_coll].take(indices)
+
+    if "size" in field:
+        if table is not None:
+            raise Exception("Field '%s': a reference with a size picks \
+                             distinct documents uniformly and cannot take a \
+                             distribution." % field["name"])
+        return compile_reference_list(field, ref_coll,
+                                      defined[ref_coll].count, take, dbname)
+
+    if table is not None:
+        # Documents are picked by index from the distribution's alias table.
+        def value(rng):
+            return DBRef(ref_coll, take(table.sample(1, rng))[0], dbname)
+
+        def column(count, rng):
+            return [DBRef(ref_coll, ref_id, dbname) for ref_id in
+                    take(table.sample(count, rng))]
+    elif strategy is not None:
+        # Ids come straight from a random document index.
+        def value(rng):
+            return DBRef(ref_coll, strategy.choice(rng), dbname)
+
+        def column(count, rng):
+            return [DBRef(ref_coll, ref_id, dbname) for ref_id in
+                    strategy.choices(rng, count)]
+    else:
+        def value(rng):
+            return DBRef(ref_coll, ids[ref_coll].choice(rng), dbname)
+
+        def column(count, rng):
+            return [DBRef(ref_coll, ref_id, dbname) for ref_id in
+                    ids[ref_coll].choices(rng, count)]
+
+    return FieldPlan(field["name"], value, column, ref_coll)
+
+def compile_reference_list(field, ref_coll, population, take, dbname):
+    '''
+    Compile a reference field with a size, whose values are lists of
+    references to distinct documents. A batch's indices are drawn together
+    and their ids looked up in one call.
+    :param field:
+    :param ref_coll:        Referenced collection.
+    :param population:      Number of documents in the referenced collection.
+    :param take:            Callable, take(indices), returning the ids of the
+                            documents at `indices`.
+    :param dbname:
+    '''
+    from bson.dbref import DBRef
+
+    size    = compile_size(field)
+    largest = size[1] - 1 if isinstance(size, tuple) else size
+    if largest > population:
+        raise Exception("Field '%s' requests up to %d distinct references to \
+                         collection '%s', which has %d documents." %
+                        (field["name"], largest, ref_coll, population))
+
+    def column(count, rng):
+        if isinstance(size, tuple):
+            sizes = [rng.randrange(size[0], size[1]) for i in range(count)]
+        else:
+            sizes = [size] * count
+        picks = distributions.sample_distinct(population, sizes, rng)
+        refs  = [DBRef(ref_coll, ref_id, dbname) for ref_id in
+                 take([index for indices in picks for index in indices])]
+        lists = []
+        pos   = 0
+        for length in sizes:
+            lists.append(refs[pos:pos + length])
+            pos = pos + length
+        return lists
+
+    def value(rng):
+        return column(1, rng)[0]
+
+    return FieldPlan(field["name"], value, column, ref_coll)
+
+def compile_distribution(generator, field, owner, size, use_numpy=False):
+    '''
+    Compile a field's "distribution" option. Returns a
+    distributions.AliasTable, or None for uniform sampling. Tables are built
+    once and shared by every field with the same distribution over the same
+    entries.
+    :param generator:
+    :param field:
+    :param owner:           Name of what is sampled: a generator name, or
+                            "ref:<collection>".
+    :param size:            Number of entries sampled from, or None if the
+                            generator does not sample entries.
+    :param use_numpy:       Sample with NumPy.
+    '''
+    spec = field["distribution"]
+    if size is None:
+        raise Exception("Field '%s': distribution only works for names, \
+                         words, lipsum and reference fields." % field["name"])
+    key = (owner, spec)
+    if key not in generator.distributions:
+        try:
+            generator.distributions[key] = distributions.compile_distribution(
+                spec, size, streams.derive_key(generator.seed, "distribution",
+                                               owner, spec), use_numpy)
+        except Exception as exc:
+            raise Exception("Field '%s': %s" % (field["name"], str(exc)))
+    return generator.distributions[key]
+
+def compile_size(field):
+    '''
+    Validate a field's size option. Returns an int, or a (lower, upper) tuple
+    for ranges.
+    :param field:
+    '''
+    size = field.get("size", 0)
+    if isinstance(size, list):
+        if (len(size) != 2 or not all(isinstance(x, int) for x in size) or
+                size[0] >= size[1] or size[0] < 0):
+            raise Exception("Field '%s' has an invalid size range %r. Ranges \
+                             are [<lower>, <upper>] with lower < upper." %
+                            (field["name"], size))
+        return (size[0], size[1])
+    if not isinstance(size, int) or size < 0:
+        raise Exception("Field '%s' has an invalid size %r." %
+                        (field["name"], size))
+    return size
+
+def compile_grammar(field):
+    '''
+    Resolve the grammar function for a field. Returns a callable taking
+    (data, rng).
+    :param field:
+    '''
+    if field.get("generator", None) == "numbers":
+        return lambda data, rng: data
+
+    field_type = field.get("type")
+    if field_type == "body":
+        return lambda data, rng: grammars.body(data, rng=rng)
+    elif field_type == "headline":
+        return lambda data, rng: grammars.headline(data)
+    elif field_type == "list":
+        return lambda data, rng: grammars.json_list(data)
+    else:
+        return lambda data, rng: " ".join(data)
@@ -4,116 +4,361 @@ dictionaries.py
 Data dictionaries
 '''
 import os
-import random
 import sys
 
+from datagen import cache
+from datagen import streams
+
 class Dictionary(object):
     '''
     Dictionary base class. Dictionaries generate data
     '''
     datafile = None        # Input file
     words    = []        # Collection of dictionary entries
+    table    = None      # Array-backed copy of words (NumPy backend only)
+    shared   = None      # cache.PackedTable in shared memory, after share()
+    rng      = None      # Default stream, used when none is passed in
+    numpy_min = 64       # Fewest random values drawn in one NumPy call
 
-    def __init__(self, datafile=None):
+    def __init__(self, datafile=None, use_numpy=None):
         '''
         Initializes the dictionary with an optional datafile.
         :param datafile:
+        :param use_numpy:       Sample with NumPy. Defaults to True when NumPy
+                                is installed.
         '''
         if datafile != None:
             self.datafile = datafile
 
+        # NumPy is optional. When it is installed, dictionaries sample whole
+        # fields (or whole batches of fields) with one vectorized draw.
+        if use_numpy is None:
+            use_numpy = streams.numpy_available()
+        elif use_numpy and not streams.numpy_available():
+            raise Exception("NumPy backend requested but NumPy is not \
+                             installed.")
+        self.use_numpy = use_numpy
+        self.rng       = streams.Stream()
+
         sys.stdout.write("* Loading %s..." % self.__class__.__name__)
         sys.stdout.flush()
 
-        self.words = self.load()
+        self.cached = False
+        self.words  = self.load()
+        if self.use_numpy:
+            self.build_table()
 
-        sys.stdout.write("done! Loaded %d bytes\n" % sys.getsizeof(self.words))
+        sys.stdout.write("done! Loaded %d entries%s\n" %
+                         (len(self.words or []),
+                          " from cache" if self.cached else ""))
         sys.stdout.flush()
-                
+
+    def build_table(self):
+        '''
+        Build the array-backed word table used by the NumPy backend.
+        '''
+        self.table = streams.get_numpy().array(self.words, dtype=object)
+
+    def pick_size(self, size, rng=None):
+        '''
+        Resolve a size option to an int. If a sequence, take the first two
+        elements as the lower and upper bounds of a range, and select a random
+        element therein.
+        :param size:
+        :param rng:             Stream to draw from.
+        '''
+        rng = rng or self.rng
+        try:
+            return int(rng.randrange(size[0], size[1]))
+        except TypeError:
+            return int(size)
+
+    def vectorize(self, count):
+        '''
+        Return True if `count` random values are drawn with NumPy. Smaller
+        draws are cheaper with random, and leave NumPy unimported when
+        nothing larger is drawn.
+        :param count:
+        '''
+        return self.use_numpy and count >= self.numpy_min
+
+    def pick_sizes(self, count, size, rng=None):
+        '''
+        Resolve a size option to a list of `count` ints.
+        :param count:
+        :param size:
+        :param rng:
+        '''
+        rng = rng or self.rng
+        try:
+            lower, upper = size[0], size[1]
+        except TypeError:
+            return [int(size)] * count
+        if self.vectorize(count):
+            return rng.numpy.integers(lower, upper, count).tolist()
+        return [rng.randrange(lower, upper) for x in range(count)]
+
+    def population(self):
+        '''
+        Return the number of entries a field samples from, or None if the
+        dictionary does not sample entries.
+        '''
+        if self.shared is not None:
+            return len(self.shared)
+        return len(self.words)
+
+    def sample(self, count, table=None, rng=None, distribution=None):
+        '''
+        Return a list of `count` random entries.
+        :param count:
+        :param table:           Entries to sample from. Defaults to the
+                                dictionary's words.
+        :param rng:
+        :param distribution:    Optional distributions.AliasTable picking the
+                                entries. Defaults to uniform.
+        '''
+        rng = rng or self.rng
+        if table is None and self.shared is not None:
+            return self.sample_shared(count, rng, distribution=distribution)
+        if self.use_numpy:
+            if table is None:
+                table = self.table
+            if distribution is not None:
+                return table[distribution.sample(count, rng)].tolist()
+            return table[rng.numpy.integers(0, len(table), count)].tolist()
+        if table is None:
+            table = self.words
+        if distribution is not None:
+            return [table[pick] for pick in distribution.sample(count, rng)]
+        return rng.choices(table, k=count)
+
+    def sample_shared(self, count, rng=None, base=0, size=None,
+                      distribution=None):
+        '''
+        Return a list of `count` random entries from the shared table. Draws
+        the same indices as sample(), so sharing does not change the output.
+        :param count:
+        :param rng:
+        :param base:            Index of the first entry to sample from.
+        :param size:            Number of entries to sample from. Defaults to
+                                the whole table.
+        :param distribution:
+        '''
+        rng = rng or self.rng
+        if size is None:
+            size = len(self.shared)
+        if distribution is not None:
+            picks = distribution.sample(count, rng)
+            if not base:
+                return self.shared.take(picks)
+            if self.use_numpy:
+                return self.shared.take(picks + base)
+            return self.shared.take([base + pick for pick in picks])
+        if self.use_numpy:
+            picks = rng.numpy.integers(0, size, count)
+            if base:
+                picks = picks + base
+            return self.shared.take(picks)
+        random = rng.random
+        return self.shared.take([base + int(random() * size)
+                                 for i in range(count)])
+
+    def entries(self):
+        '''
+        Return the list of entries to publish in shared memory.
+        '''
+        return self.words
+
+    def share(self):
+        '''
+        Move the dictionary's entries into shared memory and drop the boxed
+        copies. Worker processes forked afterwards sample the one shared table,
+        decoding only the entries they pick, instead of each process touching
+        (and so copying) the parent's lists.
+        '''
+        if self.shared is not None or not self.words:
+            return
+        self.shared = cache.share(self.entries())
+        self.words  = []
+        self.table  = None
+
+    def split(self, data, sizes):
+        '''
+        Split one flat list of samples into consecutive chunks.
+        :param data:
+        :param sizes:
+        '''
+        chunks = []
+        pos    = 0
+        for size in sizes:
+            chunks.append(data[pos:pos + size])
+            pos = pos + size
+        return chunks
 
     def load(self):
         '''
-        Return a list of words.
+        Return a list of words, from the compiled dictionary cache when it has
+        them.
+        '''
+        words, self.cached = cache.load(self.datafile, self.read,
+                                        self.__class__.__name__)
+        return words
+
+    def read(self):
+        '''
+        Parse the datafile and return a list of words.
         '''
         raise Exception("Not implemented")
 
-    def generate_data(self, size=0, **options):
+    def check_options(self, size=0, **options):
+        '''
+        Raise an exception if generate_data() would reject these options.
+        Called once per field when a template is compiled.
+        :param size:
+        '''
+        return
+
+    def generate_data(self, size=0, rng=None, **options):
         '''
         Generates a collection of random data. 
         :param size:            Amount of data to return, depending on class 
                                 context. Can be an int or range.
+        :param rng:             Stream to draw from. Defaults to the
+                                dictionary's own stream.
         '''
-        # Calculate the size. If a sequence, take the first two elements as 
-        # the lower and upper bounds of a range, and select a random element
-        # therein.
-        try:
-            size = int(random.randrange(size[0], size[1]))
-        except TypeError:
-            try: 
-                size = int(size)
-            except TypeError:
-                raise
-            
         # Generate a list of random selections from the the word list.
-        return [random.choice(self.words) for x in range(size)]
-        
-        
+        return self.sample(self.pick_size(size, rng), rng=rng,
+                           distribution=options.get("distribution"))
+
+    def generate_batch(self, count, size=0, rng=None, **options):
+        '''
+        Generates data for `count` documents at once. Returns a list with one
+        generate_data() style result per document. All entries for the batch
+        are drawn together.
+        :param count:           Number of documents.
+        :param size:            As for generate_data().
+        :param rng:
+        '''
+        sizes = self.pick_sizes(count, size, rng)
+        data  = self.sample(sum(sizes), rng=rng,
+                            distribution=options.get("distribution"))
+        return self.split(data, sizes)
+
+
 class NamesDictionary(Dictionary):
     '''
     Dictionary to generate random names.
     '''
     datafile = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                             "data/randomNames.csv"))
+    subfields = ["first_name", "last_name", "middle_init", "full_name"]
+
+    def build_table(self):
+        '''
+        Build one array-backed table per subfield.
+        '''
+        numpy      = streams.get_numpy()
+        self.table = {}
+        for subfield in self.subfields:
+            self.table[subfield] = numpy.array(self.columns[subfield],
+                                               dtype=object)
 
     def load(self):
         '''
-        Load the data from the file. The data is csv and will be returned as a 
-        list of dictionaries.
+        Load the names, one list per subfield. Returns the full names.
         '''
-        words = []
+        names = Dictionary.load(self)
+        count = len(names) // len(self.subfields)
+        self.count   = count
+        self.columns = {}
+        for i, subfield in enumerate(self.subfields):
+            self.columns[subfield] = names[i * count:(i + 1) * count]
+        return self.columns["full_name"]
+
+    def population(self):
+        '''
+        Return the number of names in each subfield.
+        '''
+        return self.count
+
+    def entries(self):
+        '''
+        Return every subfield's column in turn, as read() does.
+        '''
+        return [name for subfield in self.subfields
+                for name in self.columns[subfield]]
+
+    def share(self):
+        '''
+        Move the names into shared memory.
+        '''
+        if self.shared is not None or not self.words:
+            return
+        Dictionary.share(self)
+        self.columns = {}
+
+    def read(self):
+        '''
+        Load the data from the file. The data is csv and will be returned as
+        one list holding each subfield's column in turn.
+        '''
+        columns = [[] for subfield in self.subfields]
         try:
             with open(self.datafile, "r") as fp:
                 for line in fp.readlines():
                     if not line:
                         continue
                     line = line.strip().split(",")
-                    entry = {}
-                    entry["first_name"] = line[0]
-                    entry["last_name"] = line[1]
-                    entry["middle_init"] = line[2]
-                    entry["full_name"] = line[3]
-                    words.append(entry)
+                    for i in range(len(columns)):
+                        columns[i].append(line[i])
         except Exception as exc:
             raise Exception("Names dictionary file '%s' does not exist or could\
                              not be opened: %s" % (self.datafile, str(exc)))
         else:
-            return words
+            return [name for column in columns for name in column]
+
+    def check_options(self, size=0, **options):
+        '''
+        Check the subfield option.
+        :param size:
+        '''
+        if options.get("subfield", "full_name") not in self.subfields:
+            raise Exception("Invalid subfield specified.")
 
-    def generate_data(self, size=0, **options):
+    def generate_data(self, size=0, rng=None, **options):
         '''
         Options should contain a kwarg 'subfield' that maps to a key in a
         name dictionary (first_name, last_name, middle_init_, full_name)
         :param data:
         :param field_type:
         '''
-        try:
-            size = int(random.randrange(size[0], size[1]))
-        except TypeError:
-            try: 
-                size = int(size)
-            except TypeError:
-                raise
-            
-        # Generate a list of random selections from the the word list.
-        data     = [random.choice(self.words) for x in range(size)]
-        
+        return self.generate_batch(1, size, rng, **options)[0]
+
+    def generate_batch(self, count, size=0, rng=None, **options):
+        '''
+        Generates names for `count` documents at once.
+        :param count:
+        :param size:
+        :param rng:
+        '''
         subfield = options.get("subfield", "full_name")
-        
-        if subfield not in ["first_name", "last_name", 
-                            "middle_init", "full_name"]:
+
+        if subfield not in self.subfields:
             raise Exception("Invalid subfield specified.")
-        
-        return [name.get(subfield, " ") for name in data]
+
+        sizes        = self.pick_sizes(count, size, rng)
+        distribution = options.get("distribution")
+        if self.shared is not None:
+            data = self.sample_shared(sum(sizes), rng,
+                                      self.subfields.index(subfield) *
+                                      self.count, self.count, distribution)
+        elif self.use_numpy:
+            data = self.sample(sum(sizes), self.table[subfield], rng,
+                               distribution)
+        else:
+            data = self.sample(sum(sizes), self.columns[subfield], rng,
+                               distribution)
+        return self.split(data, sizes)
 
 class WordsDictionary(Dictionary):
     '''
@@ -122,7 +367,7 @@ class WordsDictionary(Dictionary):
     datafile = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                             "data/en-words.txt"))
 
-    def load(self):
+    def read(self):
         '''
         Load the data file.
         '''
@@ -146,7 +391,7 @@ class LipsumDictionary(Dictionary):
     datafile = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                             "data/lorem.txt"))
 
-    def load(self):
+    def read(self):
         '''
         Load the file.
         '''
@@ -164,53 +409,245 @@ class LipsumDictionary(Dictionary):
         
 class NumbersDictionary(Dictionary):
     '''
-    Dictionary for generating pseudorandom numbers
+    Dictionary for generating pseudorandom numbers.
+
+    Fields without a type are strings of `size` random digits. The formatted
+    types are strings of digit groups, and the numeric types are native BSON
+    numbers drawn from a [min, max] range. Typed fields return `size` values,
+    as a list unless there is exactly one.
+
+    Every value is one draw: a digit string is a random integer below
+    10 ** digits, zero padded, and a formatted value is one integer split
+    into its groups. With NumPy, a whole batch is drawn at once.
     '''
-    
     types = {
          "us-telno": ((3,3,4), "+1({0}){1}-{2}"),
          "us-ssn":   ((3,2,4), "{0}-{1}-{2}")
     }
-    
+
+    # Default [min, max] for each numeric type.
+    ranges = {
+        "int":     (0, 2 ** 31 - 1),
+        "float":   (0.0, 1.0),
+        "decimal": (0, 1000000)
+    }
+
+    digits_per_draw = 18    # Most digits drawn at once by NumPy
+
     def load(self):
         '''
         Does nothing
         '''
         return 
-        
-    def generate_data(self, size=0, **options):
+
+    def build_table(self):
+        '''
+        Numbers have no word table.
+        '''
+        return
+
+    def population(self):
+        '''
+        Numbers are not drawn from entries.
+        '''
+        return None
+
+    def check_options(self, size=0, **options):
+        '''
+        Check the range options of the numeric types.
+        :param size:
+        '''
+        field_type = options.get("field_type")
+        if field_type not in self.ranges:
+            return
+        low, high = self.get_range(field_type, options)
+        if field_type == "int":
+            if not (isinstance(low, int) and isinstance(high, int)):
+                raise Exception("int min and max must be integers.")
+            if low < -2 ** 63 or high >= 2 ** 63:
+                raise Exception("int min and max must fit in 64 bits.")
+        if low > high:
+            raise Exception("min must not be greater than max.")
+        if field_type == "decimal":
+            scale = options.get("scale", 2)
+            if not isinstance(scale, int) or not 0 <= scale <= 34:
+                raise Exception("decimal scale must be an integer from 0 to \
+                                 34.")
+            low, high = self.decimal_units(low, high, scale)
+            if low > high:
+                raise Exception("decimal min and max hold no value with %d \
+                                 decimal places." % scale)
+            try:
+                import bson.decimal128
+            except ImportError:
+                raise Exception("decimal numbers require the bson package, \
+                                 from pymongo.")
+
+    def decimal_units(self, low, high, scale):
+        '''
+        Return the range of whole units of 10 ** -scale within [low, high].
+        :param low:             decimal.Decimal
+        :param high:
+        :param scale:           Decimal places.
+        '''
+        import decimal
+        unit = decimal.Decimal(1).scaleb(-scale)
+        return (int((low / unit).to_integral_value(decimal.ROUND_CEILING)),
+                int((high / unit).to_integral_value(decimal.ROUND_FLOOR)))
+
+    def get_range(self, field_type, options):
+        '''
+        Return the (min, max) of a numeric type. Decimal bounds may be given
+        as strings, and are returned as decimal.Decimal.
+        :param field_type:
+        :param options:
+        '''
+        low, high = self.ranges[field_type]
+        low       = options.get("min", low)
+        high      = options.get("max", high)
+        if field_type == "decimal":
+            import decimal
+            try:
+                return decimal.Decimal(str(low)), decimal.Decimal(str(high))
+            except decimal.InvalidOperation:
+                raise Exception("decimal min and max must be numbers.")
+        if field_type == "float":
+            try:
+                return float(low), float(high)
+            except (TypeError, ValueError):
+                raise Exception("float min and max must be numbers.")
+        return low, high
+
+    def draw_ints(self, count, low, high, rng):
+        '''
+        Return `count` random integers in [low, high].
+        :param count:
+        :param low:
+        :param high:
+        :param rng:
+        '''
+        if self.vectorize(count) and -2 ** 63 <= low and high < 2 ** 63:
+            return rng.numpy.integers(low, high, count,
+                                      endpoint=True).tolist()
+        randrange = rng.randrange
+        return [randrange(low, high + 1) for x in range(count)]
+
+    def draw_digits(self, count, width, rng):
+        '''
+        Return `count` strings of `width` random digits. With NumPy, up to
+        digits_per_draw digits of every string are drawn in one call.
+        :param count:
+        :param width:
+        :param rng:
+        '''
+        if width <= 0:
+            return [""] * count
+        if not self.vectorize(count):
+            return ["%0*d" % (width, n) for n in
+                    self.draw_ints(count, 0, 10 ** width - 1, rng)]
+        parts = []
+        for pos in range(0, width, self.digits_per_draw):
+            digits = min(self.digits_per_draw, width - pos)
+            parts.append(["%0*d" % (digits, n) for n in
+                          self.draw_ints(count, 0, 10 ** digits - 1, rng)])
+        if len(parts) == 1:
+            return parts[0]
+        return ["".join(strings) for strings in zip(*parts)]
+
+    def draw_values(self, count, field_type, rng, options):
+        '''
+        Return `count` values of a formatted or numeric type.
+        :param count:
+        :param field_type:
+        :param rng:
+        :param options:
+        '''
+        if field_type in self.types:
+            groups, template = self.types[field_type]
+            bounds = []
+            pos    = 0
+            for width in groups:
+                bounds.append((pos, pos + width))
+                pos = pos + width
+            return [template.format(*[digits[start:stop]
+                                      for start, stop in bounds])
+                    for digits in self.draw_digits(count, pos, rng)]
+
+        low, high = self.get_range(field_type, options)
+        if field_type == "int":
+            return self.draw_ints(count, low, high, rng)
+        if field_type == "float":
+            if self.vectorize(count):
+                return rng.numpy.uniform(low, high, count).tolist()
+            random = rng.random
+            return [low + (high - low) * random() for x in range(count)]
+
+        # Decimals are whole numbers of units of 10 ** -scale.
+        from bson.decimal128 import Decimal128
+        import decimal
+        scale     = options.get("scale", 2)
+        low, high = self.decimal_units(low, high, scale)
+        return [Decimal128(decimal.Decimal(n).scaleb(-scale))
+                for n in self.draw_ints(count, low, high, rng)]
+
+    def generate_data(self, size=0, rng=None, **options):
         '''
         Generates a random number 
         :param size:            Amount of data to return, depending on class
         context. Can be an int or range.
+        :param rng:
         '''
-        # Calculate the size. If a sequence, take the first two elements as 
-        # the lower and upper bounds of a range, and select a random element
-        # therein.
-        try:
-            size = int(random.randrange(size[0], size[1]))
-        except TypeError:
-            try: 
-                size = int(size)
-            except TypeError:
-                raise
-            
-        if options["field_type"] not in self.types:
-            transform = None
-        else:
-            transform = self.types[options["field_type"]]
-            
-        if not transform:
-            return "".join([str(random.randrange(1, 9)) for x in range(size)])
-        
-        numbers    = []
-        numstrings = []
-        for number in range(size):
-            for count in transform[0]:
-                numbers.append("".join([str(random.randrange(1, 9)) for x in
-                                         range(count)]))
-            numstrings.append(transform[1].format(*numbers))
-        if len(numstrings) == 1:
-            return str(numstrings[0])
-        else:
-            return numstrings
\ No newline at end of file
+        return self.generate_batch(1, size, rng, **options)[0]
+
+    def generate_batch(self, count, size=0, rng=None, **options):
+        '''
+        Generates numbers for `count` documents.
+        :param count:
+        :param size:
+        :param rng:
+        '''
+        rng        = rng or self.rng
+        sizes      = self.pick_sizes(count, size, rng)
+        field_type = options.get("field_type")
+
+        if field_type not in self.types and field_type not in self.ranges:
+            if len(set(sizes)) == 1:
+                return self.draw_digits(count, sizes[0], rng)
+            return [self.draw_digits(1, width, rng)[0] for width in sizes]
+
+        values = self.split(self.draw_values(sum(sizes), field_type, rng,
+                                             options), sizes)
+        return [data[0] if len(data) == 1 else data for data in values]
+
+class DictionaryRegistry(object):
+    '''
+    Creates dictionaries on first use. Looking up a generator name loads its
+    dictionary; names a template never uses are never loaded.
+    '''
+    dictionaries = {
+        "names":   NamesDictionary,
+        "words":   WordsDictionary,
+        "lipsum":  LipsumDictionary,
+        "numbers": NumbersDictionary
+    }
+
+    def __init__(self, **options):
+        '''
+        :param options:         Passed to each dictionary's constructor.
+        '''
+        self.options = options
+        self.loaded  = {}
+
+    def __contains__(self, name):
+        return name in self.dictionaries
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            self.loaded[name] = self.dictionaries[name](**self.options)
+        return self.loaded[name]
+
+    def values(self):
+        '''
+        Return the dictionaries loaded so far.
+        '''
+        return list(self.loaded.values())
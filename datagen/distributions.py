@@ -0,0 +1,188 @@
+'''
+distributions.py
+
+Weighted sampling for dictionary entries and reference targets.
+
+A field's "distribution" sets how often each dictionary entry, or each
+document of a referenced collection, is picked:
+
+    uniform             Every entry equally often (the default).
+    zipf:<s>            Zipf's law with exponent s: the entry of rank r is
+                        picked in proportion to 1 / r^s. Ranks are dealt to
+                        the entries in a random order fixed by the seed.
+    weights:<file>      Weights read from a file, one per line, for the
+                        entries in order. Entries past the end of the file
+                        are never picked.
+
+Weighted distributions are sampled from an alias table (Vose's method),
+built once in O(n) and then O(1) per draw. Sets of distinct picks, for
+multi-valued references, are drawn uniformly by Floyd's algorithm.
+'''
+from datagen import streams
+
+class AliasTable(object):
+    '''
+    Alias table over the indices 0 to size - 1. Each index owns one column,
+    which it keeps with probability prob[index] and otherwise hands to
+    alias[index]. A draw takes one uniform value: its integer part (scaled
+    by the size) picks the column and its fractional part settles the toss.
+    '''
+    def __init__(self, weights, use_numpy=False):
+        '''
+        :param weights:         Non-negative weight of each index.
+        :param use_numpy:       Sample with NumPy.
+        '''
+        size  = len(weights)
+        total = float(sum(weights))
+        if not size or total <= 0:
+            raise Exception("A distribution needs at least one entry with a \
+                             positive weight.")
+        scaled = [weight * size / total for weight in weights]
+        prob   = [1.0] * size
+        alias  = list(range(size))
+        small  = [index for index in range(size) if scaled[index] < 1.0]
+        large  = [index for index in range(size) if scaled[index] >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            prob[less]   = scaled[less]
+            alias[less]  = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left is 1.0 but for rounding, and keeps its column.
+
+        self.size      = size
+        self.use_numpy = use_numpy
+        if use_numpy:
+            numpy      = streams.get_numpy()
+            self.prob  = numpy.array(prob, dtype=numpy.float64)
+            self.alias = numpy.array(alias, dtype=numpy.int64)
+        else:
+            self.prob  = prob
+            self.alias = alias
+
+    def __len__(self):
+        return self.size
+
+    def sample(self, count, rng):
+        '''
+        Return `count` random indices: a NumPy array with the NumPy backend,
+        otherwise a list.
+        :param count:
+        :param rng:
+        '''
+        size  = self.size
+        prob  = self.prob
+        alias = self.alias
+        if self.use_numpy:
+            numpy = streams.get_numpy()
+            draws = rng.numpy.random(count) * size
+            picks = draws.astype(numpy.int64)
+            return numpy.where(draws - picks < prob[picks], picks,
+                               alias[picks])
+        random = rng.random
+        picks  = []
+        for i in range(count):
+            draw = random() * size
+            pick = int(draw)
+            picks.append(pick if draw - pick < prob[pick] else alias[pick])
+        return picks
+
+def sample_distinct(population, sizes, rng):
+    '''
+    Return, for each size in `sizes`, a list of that many distinct indices
+    below `population`, drawn by Floyd's algorithm: one draw and one set
+    lookup per index, however large the population.
+    :param population:
+    :param sizes:
+    :param rng:
+    '''
+    random = rng.random
+    output = []
+    for size in sizes:
+        chosen = set()
+        picks  = []
+        for top in range(population - size + 1, population + 1):
+            pick = int(random() * top)
+            if pick in chosen:
+                # Taken already; top - 1 cannot have been, as every earlier
+                # draw was below it.
+                pick = top - 1
+            chosen.add(pick)
+            picks.append(pick)
+        output.append(picks)
+    return output
+
+def zipf_weights(size, exponent, rng):
+    '''
+    Return Zipf weights for `size` entries, with the ranks shuffled by `rng`.
+    :param size:
+    :param exponent:
+    :param rng:
+    '''
+    ranks = list(range(size))
+    rng.shuffle(ranks)
+    weights = [0.0] * size
+    for rank, index in enumerate(ranks):
+        weights[index] = (rank + 1.0) ** -exponent
+    return weights
+
+def read_weights(path, size):
+    '''
+    Read a weights file: one non-negative number per line, blank lines
+    skipped. Entries without a weight get 0.
+    :param path:
+    :param size:            Number of entries.
+    '''
+    weights = []
+    try:
+        with open(path) as fp:
+            for line in fp:
+                line = line.strip()
+                if line:
+                    weights.append(float(line))
+    except OSError as exc:
+        raise Exception("Weights file '%s' does not exist or could not be \
+                         opened: %s" % (path, str(exc)))
+    except ValueError as exc:
+        raise Exception("Weights file '%s' holds a line that is not a \
+                         number: %s" % (path, str(exc)))
+    if len(weights) > size:
+        raise Exception("Weights file '%s' has %d weights for %d entries." %
+                        (path, len(weights), size))
+    if any(weight < 0 for weight in weights):
+        raise Exception("Weights file '%s' holds a negative weight." % path)
+    return weights + [0.0] * (size - len(weights))
+
+def compile_distribution(spec, size, key, use_numpy=False):
+    '''
+    Parse a distribution option. Returns an AliasTable, or None for uniform
+    sampling.
+    :param spec:            "uniform", "zipf:<s>" or "weights:<file>".
+    :param size:            Number of entries sampled from.
+    :param key:             Stream key shuffling the Zipf ranks.
+    :param use_numpy:
+    '''
+    if not isinstance(spec, str):
+        raise Exception("Invalid distribution %r specified" % (spec,))
+    kind, sep, arg = spec.partition(":")
+    if kind == "uniform" and not sep:
+        return None
+    elif kind == "zipf":
+        try:
+            exponent = float(arg)
+        except ValueError:
+            exponent = 0.0
+        if not exponent > 0:
+            raise Exception("Invalid distribution '%s' specified. Zipf \
+                             distributions are 'zipf:<s>' with s > 0." % spec)
+        weights = zipf_weights(size, exponent, streams.Stream(key))
+    elif kind == "weights" and arg:
+        weights = read_weights(arg, size)
+    else:
+        raise Exception("Invalid distribution '%s' specified. Use \
+                         'uniform', 'zipf:<s>' or 'weights:<file>'." % spec)
+    return AliasTable(weights, use_numpy)
@@ -0,0 +1,113 @@
+'''
+encoders.py
+
+Output encoders. An encoder is selected once per run and applied to whole
+columns of generated values.
+'''
+import binascii
+import html
+import re
+
+class Encoder(object):
+    '''
+    Base encoder. Strings are encoded, lists are encoded element by element,
+    anything else is passed through.
+    '''
+    identity = False    # True when encoding never changes a value
+
+    def encode(self, value):
+        '''
+        Encode a single string.
+        :param value:
+        '''
+        raise NotImplementedError
+
+    def encode_value(self, data):
+        '''
+        Encode one generated value.
+        :param data:
+        '''
+        if isinstance(data, str):
+            return self.encode(data)
+        if isinstance(data, list):
+            encode = self.encode
+            return [encode(item) if isinstance(item, str) else item
+                    for item in data]
+        return data
+
+    def encode_column(self, column):
+        '''
+        Encode a column of generated values in one pass.
+        :param column:
+        '''
+        if self.identity:
+            return column
+        encode = self.encode
+        if all(isinstance(data, str) for data in column):
+            return [encode(data) for data in column]
+        encode_value = self.encode_value
+        return [encode_value(data) for data in column]
+
+class Utf8Encoder(Encoder):
+    '''
+    UTF-8. Generated strings are already valid Unicode, so this is a no-op.
+    '''
+    identity = True
+
+    def encode(self, value):
+        return value
+
+    def encode_value(self, data):
+        return data
+
+class AsciiEncoder(Encoder):
+    '''
+    ASCII. Non-ASCII characters are replaced with '?'.
+    '''
+    def encode(self, value):
+        if value.isascii():
+            return value
+        return value.encode("ascii", "replace").decode("ascii")
+
+class Base64Encoder(Encoder):
+    '''
+    Base64 of the UTF-8 encoded string.
+    '''
+    def encode(self, value):
+        return binascii.b2a_base64(value.encode("utf-8"),
+                                   newline=False).decode("ascii")
+
+class HtmlEncoder(Encoder):
+    '''
+    HTML. Markup characters are escaped, paragraph breaks from the body
+    grammar become <p> and </p> tags, and non-ASCII characters become
+    character references.
+    '''
+    tabs = re.compile("\t+")
+
+    def encode(self, value):
+        value = html.escape(value, quote=False)
+        if "\t" in value:
+            value = self.tabs.sub("<p>", value.replace("\n\n", "</p>"))
+        elif "\n\n" in value:
+            value = value.replace("\n\n", "</p>")
+        if value.isascii():
+            return value
+        return value.encode("ascii", "xmlcharrefreplace").decode("ascii")
+
+encoders = {
+    "utf-8":  Utf8Encoder,
+    "ascii":  AsciiEncoder,
+    "base64": Base64Encoder,
+    "html":   HtmlEncoder
+}
+
+def get_encoder(encoding):
+    '''
+    Return an encoder instance for an encoding name.
+    :param encoding:
+    '''
+    try:
+        return encoders[encoding]()
+    except KeyError:
+        raise Exception("Invalid encoding '%s' specified" % encoding)
@@ -3,12 +3,17 @@ generator.py
 
 Random data generator.
 '''
-from bson.dbref import DBRef
-import base64
-import cgi
-import random
-import re
-from datagen import grammars
+import time
+from datagen import checkpoint
+from datagen import compiler
+from datagen import dictionaries
+from datagen import encoders
+from datagen import idstore
+from datagen import profiler
+from datagen import sharding
+from datagen import sizing
+from datagen import streams
+from datagen import telemetry
 
 
 class Generator(object):
@@ -17,161 +22,531 @@ class Generator(object):
     data.
     '''
     
-    dbs     = {}    # Container of word dictionary objects
-    ids     = {}    # List of generated dbrefs/IDs
     output  = None  # output interface
     dbname  = None  # output database name
-    options  = {}    # Config dictionary
 
-    def __init__(self, template, output, pbar, **options):
+    def __init__(self, template, output, **options):
         self.template = template
         self.output   = output
-        self.pbar     = pbar
-        self.options.update(options)
+        self.options  = dict(options)   # Config dictionary
+        self.ids      = {}              # IdStores of referenced collections
+        self.plans    = []              # Compiled collection plans
+        self.referenced = set()         # Collections whose ids are kept
+        self.distributions = {}         # Alias tables, by (owner, spec)
+
+        if options.get("resume") and not options.get("checkpoint"):
+            raise Exception("Resuming a run needs its checkpoint directory.")
+
+        # Every document's randomness derives from the run seed. A resumed
+        # run carries on with the seed of the run it resumes.
+        self.seed = options.get("seed")
+        if self.seed is None and options.get("resume"):
+            self.seed = checkpoint.saved_seed(options.get("checkpoint"))
+        if self.seed is None:
+            self.seed = streams.new_seed()
+        self.rng = streams.Stream(streams.derive_key(self.seed))
+
+        # Client-side ObjectIds carry the run's start time. A resumed run
+        # takes it from the checkpoint.
+        self.started = int(time.time())
+
+        # With profiling on, the compiled plans time each field's stages.
+        self.profiler = None
+        if options.get("profile"):
+            self.profiler = profiler.Profiler()
+
+        # The output encoder is chosen once for the whole run.
+        self.encoder = encoders.get_encoder(options.get("encoding", "utf-8"))
         
-        self.dbs["words"]   = options["words"]
-        self.dbs["names"]   = options["names"]
-        self.dbs["lipsum"]  = options["lipsum"]
-        self.dbs["numbers"] = options["numbers"]
+        # Dictionaries are looked up by generator name when the template is
+        # compiled. A DictionaryRegistry only loads the ones that are used.
+        self.dbs = options.get("dictionaries")
+        if self.dbs is None:
+            self.dbs = dictionaries.DictionaryRegistry()
+
+        # With a checkpoint directory, progress is saved as batches are
+        # written, and a resumed run skips what is already written.
+        self.checkpoint = None
+        if options.get("checkpoint"):
+            if not output.durable:
+                raise Exception("Checkpoints need an output that returns ids \
+                                 only for written batches, such as MongoDB.")
+            self.checkpoint = checkpoint.open_checkpoint(
+                options["checkpoint"], self.settings(),
+                options.get("resume", False),
+                options.get("checkpoint_interval", 30.0), self.started)
+            self.started = self.checkpoint.started
+
+    def settings(self):
+        '''
+        Return the settings that decide which documents a run generates, as
+        recorded in checkpoints.
+        '''
+        use_numpy = getattr(self.dbs, "options", {}).get("use_numpy")
+        if use_numpy is None:
+            use_numpy = streams.numpy_available()
+        return {
+            "seed":     self.seed,
+            "template": checkpoint.fingerprint(self.template),
+            "engine":   self.options.get("engine", "batch"),
+            "encoding": self.options.get("encoding", "utf-8"),
+            "numpy":    bool(use_numpy)
+        }
+
+    def compile(self):
+        '''
+        Compile the template into collection plans, loading the dictionaries
+        it uses. Raises on any template error.
+        '''
+        self.plans = compiler.compile_template(self, self.template)
+
+        # Only collections that something depends on keep their ids. Ids
+        # from an id strategy are never kept.
+        self.referenced = set()
+        for collection in self.plans:
+            self.referenced.update(collection.dependencies)
 
     def run(self):
         '''
         Run a data generation process.
         '''
-        
-        if not self.options["preserve_database"]:
-            self.output.clear()
-        
-        # Loop through the collection definitions in the template list.
-        for collection in self.template:
-            name = collection["collection_name"]
-            count = int(collection["count"])
-            self.generate_collection(name, count, collection["fields"])
+        # Compile the whole template first, so template errors surface before
+        # anything is written.
+        if not self.plans:
+            self.compile()
+
+        if not self.options["preserve_database"] and \
+                not self.options.get("resume"):
+            self.output.clear([plan.name for plan in self.plans])
+
+        workers = int(self.options.get("workers", 1))
+        if workers > 1:
+            self.run_concurrent(workers)
+            return
+
+        # The plans are in dependency order.
+        for collection in self.plans:
+            if not self.skip_collection(collection):
+                self.generate_collection(collection)
+
+    def run_concurrent(self, workers):
+        '''
+        Generate the collections on a budget of `workers` processes. Each
+        collection starts as soon as the collections it depends on are
+        finished. Collections that are ready at the same time run at the same
+        time, splitting the free workers between them.
+        :param workers:
+        '''
+        waiting = [plan for plan in self.plans
+                   if not self.skip_collection(plan)]
+        running = []
+        done    = set([plan.name for plan in self.plans
+                       if plan not in waiting])
+        free    = workers
+        while waiting or running:
+            ready = [plan for plan in waiting if plan.dependencies <= done]
+            while ready and free > 0:
+                plan = ready.pop(0)
+                waiting.remove(plan)
+                # Only a collection started on its own gets a status line;
+                # several cannot share the terminal.
+                run = self.start_collection(plan,
+                                            max(1, free // (len(ready) + 1)),
+                                            not running and not ready)
+                running.append(run)
+                free = free - run.workers
+
+            # Wait for something to finish.
+            finished = [run for run in running if run.poll(0)]
+            while not finished:
+                finished = [run for run in running if run.poll(0.05)]
+            for run in finished:
+                running.remove(run)
+                self.finish_collection(run)
+                done.add(run.plan.name)
+                free = free + run.workers
+
+    def start_collection(self, plan, workers, show=True):
+        '''
+        Start generating a collection on its own pool of worker processes.
+        Returns a sharding.ShardedRun to pass to finish_collection().
+        :param plan:
+        :param workers:
+        :param show:            Show a status line, if progress is enabled.
+        '''
+        ranges    = self.collection_ranges(plan, workers)
+        remaining = self.announce_collection(plan, ranges)
+        run = sharding.ShardedRun(self, plan, workers,
+                                  plan.name in self.referenced,
+                                  self.create_telemetry(plan, len(ranges),
+                                                        show, remaining),
+                                  ranges)
+        run.s_time = time.time()
+        return run
 
-    def generate_collection(self, name, count, fields):
+    def finish_collection(self, run):
+        '''
+        Wait for a collection started by start_collection() and keep its ids.
+        :param run:
+        '''
+        ids = run.finish()
+        if run.keep_ids:
+            self.ids[run.plan.name] = ids
+        if run.estimate is not None:
+            self.size_collection(run.plan, run.estimate.count)
+        if self.checkpoint is not None:
+            self.checkpoint.finish(run.plan.name)
+        self.report_collection(run.plan, run.telemetry, run.s_time,
+                               run.estimate)
+
+    def announce_collection(self, plan, ranges):
+        '''
+        Print the line starting a collection. Returns the number of documents
+        left to build, or None for a size-targeted collection.
+        :param plan:
+        :param ranges:          The collection's (start, stop, written)
+                                ranges.
+        '''
+        if plan.target_size is not None:
+            print("\n>>> Building '%s' collection, up to %s of documents." %
+                  (plan.name, sizing.format_size(plan.target_size)))
+            return None
+        count = sum([stop - written for start, stop, written in ranges])
+        print("\n>>> Building '%s' collection, %d documents to build." %
+              (plan.name, count))
+        return count
+
+    def create_telemetry(self, plan, workers=1, show=True, count=None):
+        '''
+        Return a telemetry.Telemetry tracking a collection.
+        :param plan:
+        :param workers:         Number of processes that will report to it.
+        :param show:            Show a status line, if progress is enabled.
+        :param count:           Documents to generate. Defaults to the whole
+                                collection.
+        '''
+        return telemetry.Telemetry(plan.name,
+                                   plan.count if count is None else count,
+                                   workers,
+                                   self.options.get("interval", 1.0),
+                                   show and self.options.get("use_pbar", True),
+                                   self.options.get("metrics"))
+
+    def report_collection(self, plan, tracker, s_time, estimate=None):
+        '''
+        Write a collection's final telemetry and print its throughput, and
+        the size reached by a size-targeted collection.
+        :param plan:
+        :param tracker:         The collection's Telemetry.
+        :param s_time:          Time the collection was started.
+        :param estimate:        The collection's sizing.SizeEstimate, if it is
+                                size-targeted.
+        '''
+        tracker.finish()
+        elapsed = max(time.time() - s_time, 1e-9)
+        if self.profiler is not None:
+            self.profiler.collection(plan.name)["elapsed"] += elapsed
+        print(">>> Completed '%s' collection (%.1f documents/sec)." %
+              (plan.name, tracker.counters.total(telemetry.DOCUMENTS) /
+               elapsed))
+        if estimate is not None:
+            print(">>> '%s' holds %d documents, an estimated %s of BSON "
+                  "(target %s)." % (plan.name, estimate.count,
+                                    sizing.format_size(estimate.size),
+                                    sizing.format_size(estimate.target)))
+
+    def generate_collection(self, plan):
         '''
         Generate a output collection containing generated documents.
-        :param name:
-        :param count:
-        :param fields:
+        :param plan:            CollectionPlan for the collection.
         '''
-        print("\n>>> Building '%s' collection, %d documents to build." % 
-              (name, count))
-        self.ids[name] = []
+        name     = plan.name
+        workers  = int(self.options.get("workers", 1))
+        sharded  = workers > 1 and plan.target_size is None and plan.count > 1
+        ranges   = self.collection_ranges(plan, workers if sharded else 1)
+        count    = self.announce_collection(plan, ranges)
+        keep_ids = name in self.referenced
+        estimate = None
 
-        # Configure a progress indicator.
-        if self.options["use_pbar"]:
-            pbar = self.pbar(name, count)
-            pbar.start()
+        s_time = time.time()
 
-        # Produce as many documents as requested
-        for i in range(count):
-            # Generate the document and save the dbref
-            document = self.generate_document(fields)
-            doc_id   = self.output.write(name, document)
-            self.ids[name].append(doc_id)
-            if self.options["use_pbar"]:
-                pbar.update(i + 1)
+        if sharded:
+            tracker = self.create_telemetry(plan, len(ranges), True, count)
+            ids     = sharding.generate_sharded(self, plan, workers, keep_ids,
+                                                tracker, ranges)
+        else:
+            # Progress is counted per block and shown on an interval. The
+            # output reports each batch it writes.
+            tracker  = self.create_telemetry(plan, 1, True, count)
+            progress = tracker.progress
+            if self.checkpoint is not None:
+                def progress(finished):
+                    tracker.progress(finished)
+                    self.checkpoint.poll()
+            ids = None
+            self.output.set_monitor(tracker.recorder())
+            try:
+                for index, (start, stop, written) in enumerate(ranges):
+                    range_ids = self.range_ids(plan, index, start, written,
+                                               keep_ids)
+                    log = None
+                    if self.checkpoint is not None:
+                        log = self.checkpoint.log(name, index, keep_ids)
+                    estimate = self.size_estimate(plan, written)
+                    try:
+                        self.generate_documents(plan, written, stop, progress,
+                                                range_ids, log, estimate)
+                    finally:
+                        if log is not None:
+                            log.close()
+                    if ids is None:
+                        ids = range_ids
+                    elif keep_ids:
+                        ids.merge(range_ids)
+            finally:
+                self.output.set_monitor(None)
+        if keep_ids:
+            self.ids[name] = ids
+        if estimate is not None:
+            self.size_collection(plan, estimate.count)
+        if self.checkpoint is not None:
+            self.checkpoint.finish(name)
 
-        if self.options["use_pbar"]:
-            pbar.finish()
-        print(">>> Completed '%s' collection." % name)
+        self.report_collection(plan, tracker, s_time, estimate)
 
-    def generate_document(self, fields):
+    def collection_ranges(self, plan, workers):
         '''
-        Generate a document based on the supplied field definitions.
-        :param fields:
+        Return the (start, stop, written) ranges a collection is generated
+        in: one per shard, resuming from the checkpoint if there is one. A
+        size-targeted collection is one range with no stop, as where it ends
+        is only known once it gets there.
+        :param plan:
+        :param workers:
         '''
-        document = {}        # prepare an empty dictionary
-        
-        # Loop through the fields
-        for field in fields:
-            # If the field does not specify a gen, it's not going to be
-            # random.
-            if "generator" not in field:
-                # If the field type starts with "ref:", we need to build a 
-                # reference to a related collection. The name of the colletion
-                # should come after the ":"
-                if field["type"].startswith("ref:"):
-                    # Split out the related collection name
-                    ref_coll = field["type"].split(":")[1]
-                    
-                    # If we don't have any ids with that collection name, it's
-                    # possible the user input a bad name, or tried to refer to 
-                    # a collection before defining it. Raise an exception.
-                    if ref_coll not in self.ids:
-                        raise Exception("Field with name '%s' requests \
-                                         reference to collection '%s' which \
-                                         does not exist. Make sure that any \
-                                         collection referred to is defined \
-                                         before the request." % (field["name"], 
-                                                                 ref_coll))
-                        
-
-                    # Otherwise, pick a random id from the list and build a 
-                    # reference.
-                    document[field["name"]] = DBRef(ref_coll, 
-                                                    random.choice(
-                                                          self.ids[ref_coll]), 
-                                                    self.dbname) 
-
-            
-            # If a gen is specified, we'll call it to get our data.
-            else:
-                try:
-                    gen = self.dbs[field["generator"]]
-                except KeyError:
-                    raise Exception("Invalid generator '%s' specified" %  
-                                    field["generator"])
-                else:
-                    data = gen.generate_data(
-                        size=(field.get("size", 0)), 
-                        field_type=field.get("type", "words")
-                    )
-                    data = self.apply_grammar(field, data)
-                    data = self.apply_encoding(data)
-                    document[field["name"]] = data 
-        return document
-    
-    def apply_encoding(self, data):
+        if plan.target_size is not None:
+            ranges = [(0, None)]
+        else:
+            ranges = sharding.split_ranges(plan.count, workers)
+        if self.checkpoint is not None:
+            return self.checkpoint.ranges(plan.name, ranges)
+        return [(start, stop, start) for start, stop in ranges]
+
+    def range_ids(self, plan, index, start, written, keep_ids=True):
         '''
-        Return the input data encoded with the appropriate encoding.
-        :param data:
+        Return an IdStore of the ids written in a range before this run, or
+        None if they are not kept.
+        :param plan:
+        :param index:           The range's index in the collection.
+        :param start:
+        :param written:
+        :param keep_ids:
         '''
-        if type(data) != str:
-            return [self.apply_encoding(item) for item in data]
-        
-        if self.options["encoding"] == "html":
-            # convert paragraph breaks
-            data = re.sub("\n\n", "<\p>", data)
-            data = re.sub("\t+", "<p>", data)
-            return cgi.escape(data).encode('utf-8', 
-                                           'xmlcharrefreplace').decode("ascii")
-        elif self.options["encoding"] == "base64":
-            return base64.b64encode(data.encode("ascii")).decode("ascii")
-        elif self.options["encoding"] == "ascii":
-            return data.encode("ascii").decode("ascii")
-        else:                           # default: utf-8
-            return data.encode("utf-8").decode("utf-8")
-    
-    def apply_grammar(self, field, data):
+        if not keep_ids:
+            return None
+        if self.checkpoint is None:
+            return idstore.IdStore()
+        return self.checkpoint.load_ids(plan.name, index, written - start)
+
+    def size_estimate(self, plan, written=0):
         '''
-        Apply a grammar function to the input data.
-        :param field:
-        :param data:
+        Return a sizing.SizeEstimate for a size-targeted collection, carrying
+        on from the checkpoint if there is one, or None if the collection has
+        a count.
+        :param plan:
+        :param written:         Documents already written.
         '''
-        
-        if field.get("generator", None) == "numbers":
-            return data 
-        
-        if "type" not in field:
-            return " ".join(data)
-
-        if field["type"] == "body":
-            return grammars.body(data)
-        elif field["type"] == "headline":
-            return grammars.headline(data)
-        elif field["type"] == "list":
-            return grammars.json_list(data)
+        if plan.target_size is None:
+            return None
+        size = 0
+        if self.checkpoint is not None:
+            size = self.checkpoint.size(plan.name)
+        return sizing.SizeEstimate(plan.target_size, written, size)
+
+    def size_collection(self, plan, count):
+        '''
+        Set the count of a size-targeted collection once it is written, for
+        the collections that refer to it.
+        :param plan:
+        :param count:
+        '''
+        plan.count = count
+        if plan.id_strategy is not None:
+            plan.id_strategy.count = count
+
+    def skip_collection(self, plan):
+        '''
+        Return True if a resumed run already finished a collection, loading
+        its ids if they are kept.
+        :param plan:
+        '''
+        if self.checkpoint is None or not self.checkpoint.is_done(plan.name):
+            return False
+        print("\n>>> Skipping '%s' collection, finished before resuming." %
+              plan.name)
+        ranges = self.checkpoint.collections[plan.name]["ranges"]
+        if plan.target_size is not None:
+            self.size_collection(plan, ranges[0][2])
+        if plan.name in self.referenced:
+            ids = idstore.IdStore()
+            for index, (start, stop, written) in enumerate(ranges):
+                ids.merge(self.checkpoint.load_ids(plan.name, index,
+                                                   written - start))
+            self.ids[plan.name] = ids
+        return True
+
+    def generate_documents(self, plan, start, stop, progress=None, ids=None,
+                           log=None, estimate=None):
+        '''
+        Generate and write documents [start, stop) of a collection. Returns
+        `ids`.
+        :param plan:            CollectionPlan for the collection.
+        :param start:
+        :param stop:            None to carry on until `estimate` reaches its
+                                target.
+        :param progress:        Optional callable, passed the number of
+                                documents completed since the last call.
+        :param ids:             Optional IdStore to add the written ids to.
+        :param log:             Optional checkpoint.RangeLog recording the
+                                written batches.
+        :param estimate:        sizing.SizeEstimate of a size-targeted
+                                collection.
+        '''
+        block     = start // streams.BLOCK_SIZE
+        write_all = self.output.write_all
+        flush     = self.output.flush
+        finish    = self.output.finish
+
+        # With a checkpoint, each batch is recorded as soon as it is written,
+        # rather than once per block.
+        if log is not None:
+            write = self.output.write
+            def write_all(collection, documents):
+                ids = []
+                for document in documents:
+                    written = write(collection, document)
+                    if written:
+                        log.add(written)
+                        ids.extend(written)
+                return ids
+
+        # When profiling, count the documents, the time spent on the range
+        # and the part of it spent in the output.
+        profile = None
+        if self.profiler is not None:
+            profile   = self.profiler.collection(plan.name)
+            write_all = self.profiler.timed(write_all, profile, "write")
+            flush     = self.profiler.timed(flush, profile, "write")
+            finish    = self.profiler.timed(finish, profile, "write")
+            origin    = start
+            began     = time.perf_counter()
+
+        # Produce the range a block at a time. Each block always covers the
+        # same documents and draws from its own stream, so the range can start
+        # anywhere. The output buffers documents and hands back ids whenever a
+        # batch is written.
+        while start < stop if stop is not None else not estimate.done:
+            b_start = block * streams.BLOCK_SIZE
+            if estimate is None:
+                b_stop    = min(b_start + streams.BLOCK_SIZE, plan.count)
+                documents = self.generate_block(plan, block, b_stop - b_start,
+                                                start - b_start,
+                                                min(stop, b_stop) - b_start)
+                if not documents:
+                    raise Exception("Block %d of collection '%s' produced no \
+                                     documents." % (block, plan.name))
+            else:
+                # Documents take the size of the last one measured, so the
+                # block is generated from there. Only the documents up to the
+                # target are written.
+                first     = start - start % sizing.EVERY
+                b_stop    = b_start + streams.BLOCK_SIZE
+                documents = self.generate_block(plan, block, b_stop - b_start,
+                                                first - b_start,
+                                                b_stop - b_start)
+                sizes     = estimate.measure(documents, first)[start - first:]
+                kept      = estimate.add(sizes)
+                documents = documents[start - first:start - first + kept]
+                if log is not None:
+                    log.expect(sizes[:kept])
+            written = write_all(plan.name, documents)
+            if ids is not None:
+                ids.extend(written)
+            if progress:
+                progress(len(documents))
+            start = start + len(documents)
+            block = block + 1
+
+        # Write out whatever is left in the last partial batch.
+        written = flush(plan.name)
+        if ids is not None:
+            ids.extend(written)
+        if log is not None:
+            log.add(written)
+        finish(plan.name)
+        if profile is not None:
+            profile["documents"] += start - origin
+            profile["busy"] += time.perf_counter() - began
+        return ids
+
+    def generate_block(self, plan, block, size, first, last):
+        '''
+        Generate documents [first, last) of a block of `size` documents.
+        :param plan:
+        :param block:           Block number within the collection.
+        :param size:
+        :param first:
+        :param last:
+        '''
+        rng = streams.block_stream(self.seed, plan.name, block)
+        if self.options.get("engine", "batch") == "row":
+            # Documents are built one at a time, so the block only needs to be
+            # generated up to `last`.
+            b_start   = block * streams.BLOCK_SIZE
+            documents = [self.generate_document(plan, rng, b_start + i)
+                         for i in range(last)]
         else:
-            return " ".join(data)
+            # The batch engine draws field by field, so the whole block has to
+            # be built for its documents to come out the same.
+            documents = self.generate_batch(plan, size, rng,
+                                            block * streams.BLOCK_SIZE)
+        return documents[first:last]
+
+    def generate_document(self, plan, rng=None, index=None):
+        '''
+        Generate a single document from a compiled plan.
+        :param plan:
+        :param rng:             Stream to draw from. Defaults to the
+                                generator's own stream.
+        :param index:           The document's index in its collection. Needed
+                                to assign ids when the plan has an id strategy.
+        '''
+        rng      = rng or self.rng
+        document = {}
+        if plan.id_strategy is not None and index is not None:
+            document["_id"] = plan.id_strategy.id_for(index)
+        for field in plan.fields:
+            document[field.name] = field.value(rng)
+        return document
+
+    def generate_batch(self, plan, count, rng=None, start=None):
+        '''
+        Generate `count` documents from a compiled plan. Each field is
+        generated as a column of `count` values in one call, then the columns
+        are zipped into documents.
+        :param plan:
+        :param count:
+        :param rng:
+        :param start:           Index of the first document in its collection.
+                                Needed to assign ids when the plan has an id
+                                strategy.
+        '''
+        rng     = rng or self.rng
+        names   = [field.name for field in plan.fields]
+        columns = [field.column(count, rng) for field in plan.fields]
+        if plan.id_strategy is not None and start is not None:
+            names.insert(0, "_id")
+            columns.insert(0, plan.id_strategy.ids(start, count))
+        if not columns:
+            # Nothing to zip: the documents are empty.
+            return [{} for i in range(count)]
+        return [dict(zip(names, row)) for row in zip(*columns)]
@@ -1,16 +1,16 @@
 '''
 grammars.py - "Grammar transform" functions
 '''
-import io
 import random
 
-def randomize(value, bound):
+def randomize(value, bound, rng=random):
     '''
     Returns a a random value+/- bound
     :param value:
     :param bound:
+    :param rng:             Stream to draw from. Defaults to the random module.
     '''
-    return random.randrange((value - bound),(value + bound))
+    return rng.randrange((value - bound),(value + bound))
 
 def headline(data, **options):
     '''
@@ -19,64 +19,159 @@ def headline(data, **options):
     '''
     return " ".join([str(x).lower().capitalize() for x in data])
 
+# Maps the top byte of a 32-bit draw to its top 3 bits.
+TOP_BITS = bytes([byte >> 5 for byte in range(256)])
+REJECTED = bytes(range(128, 256))
+
+def draw_offsets(rng, count):
+    '''
+    Returns bytes of `count` values in 0-3, drawn exactly as `count` calls of
+    randomize(value, 2, rng) - (value - 2) would draw them, leaving the
+    stream in the same state.
+
+    randrange() over a width of 4 takes the top 3 bits of a 32-bit draw and
+    rejects values of 4 or more. Here the 32-bit draws come from one
+    getrandbits() call per round, and their top bytes are filtered and
+    shifted by bytes.translate(). Every value needs at least one draw, so a
+    round never draws more than the values still missing and the stream is
+    never overdrawn.
+    :param rng:
+    :param count:
+    '''
+    values = b""
+    while len(values) < count:
+        missing = count - len(values)
+        # Draws come out least significant first, so every fourth byte from
+        # the fourth is the top byte of one.
+        data    = rng.getrandbits(32 * missing).to_bytes(4 * missing,
+                                                         "little")
+        values  = values + data[3::4].translate(TOP_BITS, REJECTED)
+    return values
+
+def lowercase(data):
+    '''
+    Returns the items of `data` as lowercased strings, lowercased in one
+    str.lower() call.
+    :param data:
+    '''
+    words = "\0".join(map(str, data)).lower().split("\0")
+    if len(words) != len(data):
+        # Empty data, or an item holding a NUL.
+        return [str(x).lower() for x in data]
+    return words
+
+# Separators after a word without punctuation, with a comma, with a semicolon
+# and with both.
+SEPARATORS = (" ", ", ", "; ", ",; ")
+
+def punctuate(seps, start, length, offsets, first, comma, semic):
+    '''
+    Set the separators after the words of a sentence, seps[start:start +
+    length], to add its commas and semicolons. Word i of the sentence takes a
+    comma if i > comma + offsets[first + 2 * i] and a semicolon if
+    i > semic + offsets[first + 2 * i + 1].
+    :param seps:            Separator after each word, initially " ".
+    :param start:
+    :param length:
+    :param offsets:         Values from draw_offsets().
+    :param first:           Index of the sentence's first offset.
+    :param comma:           Lowest comma frequency.
+    :param semic:           Lowest semicolon frequency.
+    '''
+    # Words at or before the lowest frequency never take either, so they are
+    # skipped.
+    for i in range(max(min(comma, semic) + 1, 0), length):
+        mark = i > comma + offsets[first + 2 * i]
+        if i > semic + offsets[first + 2 * i + 1]:
+            mark = mark + 2
+        if mark:
+            seps[start + i] = SEPARATORS[mark]
+
 def sentence(data, **options):
     '''
     Returns string with first word capitalized and punctuation added.
     :param data:
     '''
-    
-    last_comma = 0
-    last_semic = 0
-    
-    output = []
-    for i in range(len(data)):
-        comma_freq = randomize(options.get("comma_freq", 7), 2)
-        semic_freq = randomize(options.get("semiq_freq", 15), 2) 
-
-        word = str(data[i]).lower()
-        if i == 0:
-            word = word.capitalize()
-        
-        
-        if (last_comma + comma_freq) < i:
-            word = word + ","
+    rng   = options.get("rng") or random
+    words = lowercase(data)
+    if not words:
+        return ". "
+    words[0] = words[0].capitalize()
+    seps     = [" "] * len(words)
+    punctuate(seps, 0, len(words), draw_offsets(rng, 2 * len(words)), 0,
+              options.get("comma_freq", 7) - 2,
+              options.get("semiq_freq", 15) - 2)
+    seps[-1] = seps[-1][:-1] + ". "
+    text = [None] * (2 * len(words))
+    text[0::2] = words
+    text[1::2] = seps
+    return "".join(text)
 
-        if (last_semic + semic_freq) < i:
-            word = word + ";"
-            
-        output.append(word)
-    
-    return " ".join(output) + ". "
-        
 def body(data, **options):
     '''
-    Returns string of sentences with paragraphs
+    Returns string of sentences with paragraphs.
+
+    The text and the draws from the stream are the same as building it one
+    sentence() at a time: a paragraph length, then for each sentence its
+    length and two draws per word, a new paragraph length after every
+    sentence that closes a paragraph, and a last sentence length that finds
+    no words left. The draws are taken in bulk, and the words are joined once
+    with the separator each one is followed by.
     :param data:
     '''
-    output = io.StringIO()
-    output.write("\t")
+    rng      = options.get("rng") or random
+    words    = lowercase(data)
+    count    = len(words)
+    para     = options.get("para_len", 5) - 2
+    length   = options.get("sentence_len", 10) - 2
+    comma    = options.get("comma_freq", 7) - 2
+    semic    = options.get("semiq_freq", 15) - 2
+    # Every word takes two draws, and there is always a paragraph length and
+    # a final sentence length: a lower bound on what the body will use. When
+    # a sentence length can be zero, which ends the body, only the words of
+    # the current sentence are sure to be used.
+    whole    = length > 0
+    offsets  = bytearray(draw_offsets(rng, 2 * count + 2 if whole else 2))
+    index    = 1
+    para_len = para + offsets[0]
+    seps     = [" "] * count
+    pos      = 0
+    sentences = 0
 
-    para_len     = randomize(options.get("para_len", 5), 2)
-    pos          = 0
-    sentences    = 0
-    
     while True:
-        # Slice out a sentence worth of data and transform it to a sentence.
-        sentence_len = randomize(options.get("sentence_len", 10), 2)
-        sliced = data[pos:(pos+sentence_len)]
-        if len(sliced) > 0:
-            output.write(sentence(sliced, **options))
-            sentences = sentences + 1
-            pos       = pos + sentence_len
-            if sentences >= para_len:
-                output.write("\n\n\t")
-                para_len = randomize(options.get("para_len", 5), 2)
-        else:
+        left = max(count - pos, 0) if whole else 0
+        if index == len(offsets):
+            offsets.extend(draw_offsets(rng, 2 * left + 1))
+        sentence_len = length + offsets[index]
+        index        = index + 1
+        size         = min(sentence_len, count - pos) if pos < count else 0
+        if size <= 0:
             break
-    
-    text_body = output.getvalue().rstrip() + "\n\n"
-    output.close()
-    return text_body
+        if index + 2 * size > len(offsets):
+            offsets.extend(draw_offsets(rng, index + 2 * max(left, size) +
+                                        1 - len(offsets)))
+        words[pos] = words[pos].capitalize()
+        punctuate(seps, pos, size, offsets, index, comma, semic)
+        index     = index + 2 * size
+        sentences = sentences + 1
+        pos       = pos + sentence_len
+        end       = min(pos, count) - 1
+        if sentences >= para_len:
+            seps[end] = seps[end][:-1] + ". \n\n\t"
+            if index == len(offsets):
+                left = max(count - pos, 0) if whole else 0
+                offsets.extend(draw_offsets(rng, 2 * left + 2))
+            para_len = para + offsets[index]
+            index    = index + 1
+        else:
+            seps[end] = seps[end][:-1] + ". "
+
+    # A sentence length of zero ends the body early.
+    used = min(pos, count)
+    text = [None] * (2 * used)
+    text[0::2] = words[:used]
+    text[1::2] = seps[:used]
+    return ("\t" + "".join(text)).rstrip() + "\n\n"
 
 def json_list(data, **options):
     '''
@@ -0,0 +1,325 @@
+'''
+idstore.py
+
+Compact storage for the ids of written documents, used to build references.
+
+Ids are packed into a single bytearray at a fixed width per id: 12 bytes for
+ObjectIds, 8 for integers and 16 for hex UUID strings. Ids of any other type
+fall back to a plain list.
+
+Collections with an id strategy assign their own ids from the document index
+and need no store at all.
+'''
+import struct
+import time
+
+from datagen import streams
+
+def object_id():
+    '''
+    Return the bson ObjectId class. bson is imported on first use, so runs
+    that never handle an ObjectId skip the import.
+    '''
+    from bson.objectid import ObjectId
+    return ObjectId
+
+class ObjectIdCodec(object):
+    '''
+    12-byte ObjectIds.
+    '''
+    width = 12
+
+    def __init__(self):
+        self.unpack = object_id()
+
+    def pack(self, ids):
+        return b"".join([oid.binary for oid in ids])
+
+class IntCodec(object):
+    '''
+    Signed 64-bit integers.
+    '''
+    width  = 8
+    format = struct.Struct("<q")
+
+    def pack(self, ids):
+        return struct.pack("<%dq" % len(ids), *ids)
+
+    def unpack(self, data):
+        return self.format.unpack(data)[0]
+
+class HexCodec(object):
+    '''
+    32-character hex strings, as returned by StdoutInterface.
+    '''
+    width = 16
+
+    def pack(self, ids):
+        return bytes.fromhex("".join(ids))
+
+    def unpack(self, data):
+        return data.hex()
+
+def pick_codec(doc_id):
+    '''
+    Return a codec for ids like `doc_id`, or None if it has no fixed-width
+    form.
+    :param doc_id:
+    '''
+    if type(doc_id).__name__ == "ObjectId" and \
+            isinstance(doc_id, object_id()):
+        return ObjectIdCodec()
+    if isinstance(doc_id, int) and not isinstance(doc_id, bool):
+        return IntCodec()
+    if isinstance(doc_id, str) and len(doc_id) == 32:
+        try:
+            bytes.fromhex(doc_id)
+        except ValueError:
+            return None
+        return HexCodec()
+    return None
+
+class IdStore(object):
+    '''
+    An append-only sequence of document ids with O(1) random access.
+    '''
+    def __init__(self):
+        self.codec = None       # Chosen from the first id stored
+        self.data  = None       # bytearray, or list without a codec
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index = index + self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("id index out of range")
+        if self.codec is None:
+            return self.data[index]
+        width = self.codec.width
+        return self.codec.unpack(bytes(self.data[index * width:
+                                                 (index + 1) * width]))
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def extend(self, ids):
+        '''
+        Append a sequence of ids.
+        :param ids:
+        '''
+        ids = list(ids)
+        if not ids:
+            return
+        if self.data is None:
+            self.codec = pick_codec(ids[0])
+            self.data  = [] if self.codec is None else bytearray()
+        if self.codec is not None:
+            try:
+                packed = self.codec.pack(ids)
+            except (AttributeError, TypeError, ValueError, struct.error):
+                # Mixed id types; keep everything boxed from here on.
+                self.data  = list(self)
+                self.codec = None
+            else:
+                self.data.extend(packed)
+                self.count = self.count + len(ids)
+                return
+        self.data.extend(ids)
+        self.count = self.count + len(ids)
+
+    def merge(self, other):
+        '''
+        Append all the ids from another store.
+        :param other:
+        '''
+        if not other.count:
+            return
+        if self.data is None:
+            self.codec = other.codec
+            self.data  = [] if other.codec is None else bytearray()
+        if (self.codec is not None and other.codec is not None and
+                type(self.codec) is type(other.codec)):
+            self.data.extend(other.data)
+            self.count = self.count + other.count
+        else:
+            self.extend(other)
+
+    def choice(self, rng):
+        '''
+        Return a random id.
+        :param rng:
+        '''
+        if not self.count:
+            raise IndexError("Cannot choose from an empty id store")
+        return self[rng.randrange(self.count)]
+
+    def choices(self, rng, k):
+        '''
+        Return `k` random ids, drawn with replacement.
+        :param rng:
+        :param k:
+        '''
+        count  = self.count
+        random = rng.random
+        if self.codec is None:
+            data = self.data
+            return [data[int(random() * count)] for i in range(k)]
+        data   = self.data
+        width  = self.codec.width
+        unpack = self.codec.unpack
+        picks  = [int(random() * count) * width for i in range(k)]
+        return [unpack(bytes(data[pos:pos + width])) for pos in picks]
+
+    def take(self, indices):
+        '''
+        Return the ids at a sequence of indices.
+        :param indices:
+        '''
+        if self.codec is None:
+            data = self.data
+            return [data[index] for index in indices]
+        data   = self.data
+        width  = self.codec.width
+        unpack = self.codec.unpack
+        return [unpack(bytes(data[index * width:(index + 1) * width]))
+                for index in indices]
+
+    def nbytes(self):
+        '''
+        Approximate memory held by the stored ids, in bytes.
+        '''
+        if self.data is None:
+            return 0
+        if self.codec is None:
+            return len(self.data) * 8
+        return len(self.data)
+
+class IdStrategy(object):
+    '''
+    Base class for client-side id strategies. A strategy maps a document's
+    index in its collection to its _id, so references to the collection can
+    be built without storing any ids.
+    '''
+    def __init__(self, collection, count, seed, started=None):
+        '''
+        :param collection:      Collection name.
+        :param count:           Number of documents in the collection.
+        :param seed:            Run seed.
+        :param started:         Time the run started, in whole seconds.
+                                Defaults to now.
+        '''
+        self.collection = collection
+        self.count      = count
+        self.seed       = seed
+        self.started    = int(time.time()) if started is None else started
+
+    def __len__(self):
+        return self.count
+
+    def id_for(self, index):
+        '''
+        Return the id of the document at `index`.
+        :param index:
+        '''
+        raise NotImplementedError
+
+    def ids(self, start, count):
+        '''
+        Return the ids of documents [start, start + count).
+        :param start:
+        :param count:
+        '''
+        id_for = self.id_for
+        return [id_for(index) for index in range(start, start + count)]
+
+    def choice(self, rng):
+        '''
+        Return the id of a random document.
+        :param rng:
+        '''
+        return self.id_for(rng.randrange(self.count))
+
+    def choices(self, rng, k):
+        '''
+        Return the ids of `k` random documents, drawn with replacement.
+        :param rng:
+        :param k:
+        '''
+        count  = self.count
+        random = rng.random
+        id_for = self.id_for
+        return [id_for(int(random() * count)) for i in range(k)]
+
+    def take(self, indices):
+        '''
+        Return the ids of the documents at a sequence of indices.
+        :param indices:
+        '''
+        id_for = self.id_for
+        return [id_for(index) for index in indices]
+
+class SequentialIds(IdStrategy):
+    '''
+    Integer ids 0, 1, 2, ...
+    '''
+    def id_for(self, index):
+        return index
+
+    def ids(self, start, count):
+        return list(range(start, start + count))
+
+class ObjectIds(IdStrategy):
+    '''
+    ObjectIds made client-side: the run's start time followed by a 64-bit
+    counter that starts at an offset drawn from the seed. Ids increase with
+    the document index, like server-generated ObjectIds. A resumed run keeps
+    the start time of the run it resumes, so its ids match.
+    '''
+    def __init__(self, collection, count, seed, started=None):
+        IdStrategy.__init__(self, collection, count, seed, started)
+        self.prefix    = struct.pack(">I", self.started & 0xffffffff)
+        self.base      = streams.derive_key(seed, collection, "_id") >> 65
+        self.object_id = object_id()
+
+    def id_for(self, index):
+        counter = (self.base + index) & 0xffffffffffffffff
+        return self.object_id(self.prefix + counter.to_bytes(8, "big"))
+
+class DeterministicIds(IdStrategy):
+    '''
+    ObjectIds hashed from (seed, collection, index). The same seed always
+    gives the same ids.
+    '''
+    def __init__(self, collection, count, seed, started=None):
+        IdStrategy.__init__(self, collection, count, seed, started)
+        self.object_id = object_id()
+
+    def id_for(self, index):
+        key = streams.derive_key(self.seed, self.collection, "_id", index)
+        return self.object_id(key.to_bytes(16, "big")[:12])
+
+strategies = {
+    "objectid":      ObjectIds,
+    "sequential":    SequentialIds,
+    "deterministic": DeterministicIds
+}
+
+def get_strategy(name, collection, count, seed, started=None):
+    '''
+    Return an id strategy instance for a template's "id_strategy" value.
+    :param name:
+    :param collection:
+    :param count:
+    :param seed:
+    :param started:
+    '''
+    try:
+        return strategies[name](collection, count, seed, started)
+    except KeyError:
+        raise Exception("Collection '%s' has an invalid id_strategy '%s'. \
+                         Valid strategies are: %s" %
+                        (collection, name, ", ".join(sorted(strategies))))
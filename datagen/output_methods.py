@@ -3,69 +3,566 @@ output_methods.py
 
 Output handlers
 '''
+import collections
+import json
+import os
+import time
+import uuid
+
+from datagen import idstore
 
 class OutputInterface(object):
     '''
-    Base output handler. Does nothing.
+    Base output handler. Documents passed to write() are buffered per
+    collection and handed to write_many() in batches of `batch_size`.
     '''
-    def clear(self):
+    batch_size  = 1000  # Documents per batch
+    ordered     = True  # Stop a batch at the first failed document
+    thread_safe = False # write_many() may be called from several threads
+    durable     = False # write_many() returns once its batch is written
+    monitor     = None  # Called with (seconds, bytes) for each batch written
+    bytes_written = None  # Bytes written so far, if the interface knows
+
+    def __init__(self, batch_size=None, ordered=None, **options):
+        '''
+        Configure batching.
+        :param batch_size:      Number of documents buffered before a flush.
+        :param ordered:         Whether batches are written in order.
+        '''
+        if batch_size is not None:
+            if int(batch_size) < 1:
+                raise Exception("Batch size must be at least 1.")
+            self.batch_size = int(batch_size)
+        if ordered is not None:
+            self.ordered = bool(ordered)
+        self.buffers = {}
+
+    def clear(self, collections=()):
+        '''
+        Remove earlier output before a run.
+        :param collections:     Names of the collections the run generates.
+        '''
+        raise NotImplementedError
+
+    def clone(self):
         '''
-        Does nothing.
+        Return a new interface with the same configuration, for use in another
+        process.
         '''
         raise NotImplementedError
-    
-    def write(self):
+
+    def write(self, collection, document):
+        '''
+        Buffer a document. Returns the ids of any documents written as a
+        result (an empty list until the buffer fills).
+        :param collection:
+        :param document:
+        '''
+        buffer = self.buffers.setdefault(collection, [])
+        buffer.append(document)
+        if len(buffer) >= self.batch_size:
+            return self.flush(collection)
+        return []
+
+    def write_all(self, collection, documents):
         '''
-        Does nothing.
+        Buffer a sequence of documents. Returns the ids of any documents
+        written as a result.
+        :param collection:
+        :param documents:
+        '''
+        ids = []
+        for document in documents:
+            ids.extend(self.write(collection, document))
+        return ids
+
+    def flush(self, collection):
+        '''
+        Write out any buffered documents for a collection and return their
+        ids, in the order the documents were written.
+        :param collection:
+        '''
+        buffer = self.buffers.pop(collection, None)
+        if not buffer:
+            return []
+        return list(self.write_batch(collection, buffer))
+
+    def set_monitor(self, monitor):
+        '''
+        Set the callable told about each batch written: passed the seconds
+        write_many() took and the bytes it wrote, or None if unknown.
+        :param monitor:         Callable, or None to stop monitoring.
+        '''
+        self.monitor = monitor
+
+    def write_batch(self, collection, documents):
+        '''
+        write_many(), reporting the batch to the monitor.
+        :param collection:
+        :param documents:
+        '''
+        monitor = self.monitor
+        if monitor is None:
+            return self.write_many(collection, documents)
+        before  = self.bytes_written
+        start   = time.perf_counter()
+        ids     = self.write_many(collection, documents)
+        elapsed = time.perf_counter() - start
+        monitor(elapsed, None if before is None
+                else self.bytes_written - before)
+        return ids
+
+    def write_many(self, collection, documents):
+        '''
+        Persist a batch of documents and return their ids.
+        :param collection:
+        :param documents:
         '''
         raise NotImplementedError
-    
+
+    def finish(self, collection):
+        '''
+        Called once this process has written its share of a collection, after
+        the last flush. Does nothing unless an interface writes asynchronously.
+        :param collection:
+        '''
+        return
+
 class MongoInterface(OutputInterface):
     '''
     Mongo handler, writes out to a preconfigured mongo instance.
     '''
-    options = {}
-    def __init__(self, mongo, dbname, **options):
+    options     = {}
+    thread_safe = True  # MongoClient is thread safe
+    durable     = True  # insert_many() returns once the server acknowledges
+    def __init__(self, mongo, dbname, batch_size=None, ordered=None,
+                 **options):
         '''
         Creates a mongo output interface.
         :param mongo:
         :param dbname:
+        :param batch_size:
+        :param ordered:
         '''
+        OutputInterface.__init__(self, batch_size, ordered)
         self.output = mongo
         self.dbname = dbname
         self.options.update(options)
-        
-    def clear(self):
+
+    def clear(self, collections=()):
         '''
         Drop the database
+        :param collections:
         '''
         return self.output.drop_database(self.dbname)
 
+    def clone(self):
+        '''
+        Return an interface with its own client. MongoClient instances must not
+        be shared across a fork.
+        '''
+        import pymongo
+        client = pymongo.MongoClient(self.options.get("hostname", "localhost"),
+                                     self.options.get("port", 27017))
+        return MongoInterface(client, self.dbname, self.batch_size,
+                              self.ordered, **self.options)
+
+    def write_many(self, collection, documents):
+        '''
+        Persist a batch of documents with a single insert_many round trip.
+        :param collection:
+        :param documents:
+        '''
+        db = self.output[self.dbname]
+        result = db[collection].insert_many(documents, ordered=self.ordered)
+        return result.inserted_ids
+
+class PipelinedInterface(OutputInterface):
+    '''
+    Wraps another interface so batches are written by background threads
+    while the caller generates the next ones.
+
+    Full batches are handed to a pool of writer threads. At most `depth`
+    batches may be queued or being written at once; beyond that write()
+    blocks, which caps memory. Ids are returned in the order the batches
+    were submitted, as each batch at the front of the line completes, and
+    flush() waits for all of a collection's batches.
+    '''
+    depth = 4           # Batches queued or being written
+
+    def __init__(self, output, writers=1, depth=None):
+        '''
+        :param output:          Interface to write to.
+        :param writers:         Number of writer threads. Interfaces that are
+                                not thread_safe are written to by one thread
+                                at a time.
+        :param depth:
+        '''
+        OutputInterface.__init__(self, output.batch_size, output.ordered)
+        if int(writers) < 1:
+            raise Exception("Pipelined output needs at least 1 writer.")
+        self.output   = output
+        self.writers  = int(writers)
+        if depth is not None:
+            self.depth = max(int(depth), 1)
+        self.pending  = {}      # Futures of submitted batches, by collection
+        self.executor = None
+        self.slots    = None
+        self.lock     = None
+
+    @property
+    def durable(self):
+        return self.output.durable
+
+    def clear(self, collections=()):
+        return self.output.clear(collections)
+
+    def clone(self):
+        return PipelinedInterface(self.output.clone(), self.writers,
+                                  self.depth)
+
     def write(self, collection, document):
         '''
-        Persist a document to output.
+        Buffer a document, submitting the batch once it is full. Returns the
+        ids of any batches completed since the last call.
         :param collection:
         :param document:
         '''
-        db = getattr(self.output, self.dbname)
-        return db[collection].insert(document)
-    
+        buffer = self.buffers.setdefault(collection, [])
+        buffer.append(document)
+        if len(buffer) >= self.batch_size:
+            self.submit(collection)
+            return self.collect(collection)
+        return []
+
+    def flush(self, collection):
+        '''
+        Submit any buffered documents and wait for every batch of the
+        collection to be written. Returns the ids not yet returned.
+        :param collection:
+        '''
+        self.submit(collection)
+        return self.collect(collection, True)
+
+    def submit(self, collection):
+        '''
+        Hand the collection's buffered documents to the writer threads.
+        Blocks while `depth` batches are already in flight.
+        :param collection:
+        '''
+        buffer = self.buffers.pop(collection, None)
+        if not buffer:
+            return
+        if self.executor is None:
+            # Started on first use, so a clone in a forked worker gets its
+            # own threads.
+            import concurrent.futures
+            import threading
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                self.writers)
+            self.slots    = threading.BoundedSemaphore(self.depth)
+            if not self.output.thread_safe:
+                self.lock = threading.Lock()
+        self.slots.acquire()
+        future = self.executor.submit(self.write_many, collection, buffer)
+        future.add_done_callback(lambda future: self.slots.release())
+        self.pending.setdefault(collection, collections.deque()).append(future)
+
+    def collect(self, collection, wait=False):
+        '''
+        Return the ids of completed batches at the front of the collection's
+        line, raising any error a writer hit.
+        :param collection:
+        :param wait:            Wait for every pending batch.
+        '''
+        pending = self.pending.get(collection)
+        ids     = []
+        while pending and (wait or pending[0].done()):
+            ids.extend(pending.popleft().result())
+        return ids
+
+    def write_many(self, collection, documents):
+        '''
+        Write one batch to the wrapped interface. Runs on a writer thread.
+        :param collection:
+        :param documents:
+        '''
+        if self.lock is None:
+            return list(self.output.write_batch(collection, documents))
+        with self.lock:
+            return list(self.output.write_batch(collection, documents))
+
+    def set_monitor(self, monitor):
+        self.output.set_monitor(monitor)
+
+    def finish(self, collection):
+        self.output.finish(collection)
+
+class NullInterface(OutputInterface):
+    '''
+    Discards documents after encoding them to BSON, as the driver would
+    before an insert. Used to measure generation on its own.
+    '''
+    durable = True      # Nothing is kept, so nothing is lost
+    def __init__(self, batch_size=None, ordered=None, **options):
+        OutputInterface.__init__(self, batch_size, ordered)
+        self.documents     = 0  # Documents written
+        self.bytes_written = 0  # Their total BSON size
+
+    def clear(self, collections=()):
+        pass
+
+    def clone(self):
+        return NullInterface(self.batch_size, self.ordered)
+
+    def write_many(self, collection, documents):
+        '''
+        Encode the documents and return their ids. Documents without an _id
+        are given a new ObjectId.
+        :param collection:
+        :param documents:
+        '''
+        import bson
+        encode    = bson.encode
+        object_id = idstore.object_id()
+        ids       = []
+        size      = 0
+        for document in documents:
+            if "_id" not in document:
+                document["_id"] = object_id()
+            ids.append(document["_id"])
+            size = size + len(encode(document))
+        self.documents     = self.documents + len(documents)
+        self.bytes_written = self.bytes_written + size
+        return ids
+
 class StdoutInterface(OutputInterface):
     '''
     Output interface for stdout. Used for testing templates.
     '''
-    def __init__(self, *args, **kwargs):
-        pass
+    durable = True
+    def __init__(self, batch_size=None, ordered=None, *args, **kwargs):
+        OutputInterface.__init__(self, batch_size, ordered)
 
-    def clear(self):
+    def clear(self, collections=()):
         pass
-    
-    def write(self, collection, document):
+
+    def clone(self):
+        return StdoutInterface(self.batch_size, self.ordered)
+
+    def write_many(self, collection, documents):
         '''
-        Writes the document to stdout and returns a random ID string.
+        Writes the documents to stdout and returns their ids. Documents
+        without an _id get a random ID string.
+        :param collection:
+        :param documents:
+        '''
+        ids = []
+        for document in documents:
+            print(document)
+            if "_id" in document:
+                ids.append(document["_id"])
+            else:
+                ids.append(uuid.uuid4().hex)
+        return ids
+
+def extended_json(value):
+    '''
+    json.dumps() default hook. Returns the MongoDB Extended JSON form of the
+    BSON types datagen generates, as read by mongoimport.
+    :param value:
+    '''
+    from bson.dbref import DBRef
+    from bson.decimal128 import Decimal128
+    from bson.objectid import ObjectId
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, DBRef):
+        return {"$ref": value.collection, "$id": value.id}
+    if isinstance(value, Decimal128):
+        return {"$numberDecimal": str(value)}
+    raise TypeError("Cannot write %s to JSON" % type(value).__name__)
+
+class JsonLinesInterface(OutputInterface):
+    '''
+    Writes each collection to a JSON Lines file, <collection>.jsonl, in an
+    output directory, optionally compressed with gzip or zstd. Files can be
+    loaded with mongoimport.
+
+    Documents are encoded as they are flushed and collected into chunks of
+    `chunk_size` bytes. A background thread compresses each chunk and appends
+    it to the file, while generation carries on. Every chunk is compressed on
+    its own (as a gzip member or zstd frame), and appended under a file lock,
+    so processes can write to the same file.
+    '''
+    extensions = {
+        None:   ".jsonl",
+        "gzip": ".jsonl.gz",
+        "zstd": ".jsonl.zst"
+    }
+    chunk_size = 1 << 20    # Bytes of JSON per compressed chunk
+    queue_size = 8          # Chunks waiting for the writer thread
+
+    def __init__(self, directory, compression=None, batch_size=None,
+                 ordered=None, **options):
+        '''
+        Creates a JSON Lines output interface.
+        :param directory:       Output directory. Created if missing.
+        :param compression:     None, "gzip" or "zstd".
+        :param batch_size:
+        :param ordered:
+        '''
+        OutputInterface.__init__(self, batch_size, ordered)
+        if compression not in self.extensions:
+            raise Exception("Invalid compression '%s' specified" % compression)
+        self.directory   = directory
+        self.compression = compression
+        self.compress    = self.get_compressor(compression)
+        self.encode      = json.JSONEncoder(ensure_ascii=False,
+                                            separators=(",", ":"),
+                                            default=extended_json).encode
+        self.chunks      = {}   # Encoded lines not yet queued, by collection
+        self.bytes_written = 0  # Bytes of JSON encoded, before compression
+        self.files       = {}   # Open file descriptors, by collection
+        self.queue       = None
+        self.thread      = None
+        self.error       = None
+        os.makedirs(directory, exist_ok=True)
+
+    def get_compressor(self, compression):
+        '''
+        Return a function compressing one chunk to a self-contained gzip
+        member or zstd frame.
+        :param compression:
+        '''
+        if compression == "gzip":
+            import gzip
+            return lambda data: gzip.compress(data, 6, mtime=0)
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("zstd compression requires the zstandard \
+                                 package.")
+            return zstandard.ZstdCompressor(level=3).compress
+        return None
+
+    def path(self, collection):
+        '''
+        Return the output file path for a collection.
+        :param collection:
+        '''
+        return os.path.join(self.directory,
+                            collection + self.extensions[self.compression])
+
+    def clear(self, collections=()):
+        '''
+        Delete the existing output files of the collections being generated.
+        Other files in the directory are left alone.
+        :param collections:
+        '''
+        for collection in collections:
+            if os.path.exists(self.path(collection)):
+                os.unlink(self.path(collection))
+
+    def clone(self):
+        return JsonLinesInterface(self.directory, self.compression,
+                                  self.batch_size, self.ordered)
+
+    def write_many(self, collection, documents):
+        '''
+        Encode a batch of documents and return their ids. Documents without
+        an _id are given a new ObjectId, as the MongoDB driver would.
+        :param collection:
+        :param documents:
+        '''
+        ids    = []
+        lines  = []
+        encode = self.encode
+        for document in documents:
+            if "_id" not in document:
+                document["_id"] = idstore.object_id()()
+            ids.append(document["_id"])
+            lines.append(encode(document))
+        lines.append("")
+        data  = "\n".join(lines).encode("utf-8")
+        chunk = self.chunks.setdefault(collection, [])
+        chunk.append(data)
+        self.bytes_written = self.bytes_written + len(data)
+        if sum([len(data) for data in chunk]) >= self.chunk_size:
+            self.queue_chunk(collection)
+        return ids
+
+    def queue_chunk(self, collection):
+        '''
+        Hand a collection's pending lines to the writer thread. Blocks while
+        the queue is full, so generation cannot run far ahead of the disk.
+        :param collection:
+        '''
+        chunk = self.chunks.pop(collection, None)
+        if not chunk:
+            return
+        if self.thread is None:
+            import queue
+            import threading
+            self.queue  = queue.Queue(self.queue_size)
+            self.thread = threading.Thread(target=self.run_writer,
+                                           daemon=True)
+            self.thread.start()
+        self.check_error()
+        if collection not in self.files:
+            self.files[collection] = os.open(self.path(collection),
+                                             os.O_WRONLY | os.O_CREAT |
+                                             os.O_APPEND, 0o644)
+        self.queue.put((self.files[collection], b"".join(chunk)))
+
+    def run_writer(self):
+        '''
+        Writer thread. Compresses and appends chunks until the interface is
+        discarded.
+        '''
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+        while True:
+            fd, data = self.queue.get()
+            try:
+                if self.error is None:
+                    if self.compress is not None:
+                        data = self.compress(data)
+                    if fcntl is not None:
+                        fcntl.flock(fd, fcntl.LOCK_EX)
+                    try:
+                        view = memoryview(data)
+                        while view:
+                            view = view[os.write(fd, view):]
+                    finally:
+                        if fcntl is not None:
+                            fcntl.flock(fd, fcntl.LOCK_UN)
+            except Exception as exc:
+                self.error = exc
+            finally:
+                self.queue.task_done()
+
+    def check_error(self):
+        '''
+        Raise any error from the writer thread.
+        '''
+        if self.error is not None:
+            raise Exception("Failed to write JSON Lines output: %s" %
+                            str(self.error))
+
+    def finish(self, collection):
+        '''
+        Write out the collection's remaining lines, wait for the writer thread
+        and close the file.
         :param collection:
-        :param document:
         '''
-        import uuid
-        print(document)
-        return uuid.uuid4().hex
+        self.queue_chunk(collection)
+        if self.queue is not None:
+            self.queue.join()
+        fd = self.files.pop(collection, None)
+        if fd is not None:
+            os.close(fd)
+        self.check_error()
@@ -0,0 +1,152 @@
+'''
+profiler.py
+
+Per-field, per-stage timing for --profile.
+
+When a run is profiled, the template compiler times each field's generate,
+grammar and encode stages, and the generator times writes and whole
+collections. Times are summed across every process taking part in the run.
+'''
+import json
+import time
+
+STAGES = ("generate", "grammar", "encode")
+
+class Profiler(object):
+    '''
+    Accumulates stage times for a run.
+    '''
+    def __init__(self):
+        self.fields      = {}   # (collection, field) -> [seconds per stage]
+        self.collections = {}   # collection -> collection totals
+
+    def field(self, collection, field):
+        '''
+        Return the list of per-stage seconds for a field, in STAGES order.
+        Compiled fields add to it in place.
+        :param collection:
+        :param field:
+        '''
+        return self.fields.setdefault((collection, field),
+                                      [0.0] * len(STAGES))
+
+    def collection(self, collection):
+        '''
+        Return the totals for a collection: documents generated, seconds spent
+        generating and writing them ("busy"), seconds of that spent writing,
+        and wall clock seconds ("elapsed").
+        :param collection:
+        '''
+        if collection not in self.collections:
+            self.collections[collection] = {"documents": 0, "busy": 0.0,
+                                            "write": 0.0, "elapsed": 0.0}
+        return self.collections[collection]
+
+    def timed(self, func, totals, key):
+        '''
+        Return a wrapper of `func` that adds the seconds spent in each call
+        to totals[key].
+        :param func:
+        :param totals:          Collection totals, from collection().
+        :param key:
+        '''
+        clock = time.perf_counter
+        def timed(*args):
+            start  = clock()
+            result = func(*args)
+            totals[key] += clock() - start
+            return result
+        return timed
+
+    def snapshot(self):
+        '''
+        Return the accumulated times in a form that can be sent between
+        processes and passed to merge().
+        '''
+        return {"fields": dict([(key, list(times)) for key, times in
+                                self.fields.items()]),
+                "collections": dict([(name, dict(totals)) for name, totals in
+                                     self.collections.items()])}
+
+    def reset(self):
+        '''
+        Zero every accumulated time. Compiled fields keep their lists.
+        '''
+        for times in self.fields.values():
+            times[:] = [0.0] * len(STAGES)
+        for totals in self.collections.values():
+            for key in totals:
+                totals[key] = 0 if key == "documents" else 0.0
+
+    def merge(self, snapshot):
+        '''
+        Add the times from another process's snapshot.
+        :param snapshot:
+        '''
+        for (collection, field), times in snapshot["fields"].items():
+            mine = self.field(collection, field)
+            for i, seconds in enumerate(times):
+                mine[i] = mine[i] + seconds
+        for name, totals in snapshot["collections"].items():
+            mine = self.collection(name)
+            for key in ("documents", "busy", "write"):
+                mine[key] = mine[key] + totals[key]
+
+    def rows(self):
+        '''
+        Return one row per field stage, plus each collection's write stage
+        and untimed remainder, ranked by total time. Each row is a dict with
+        collection, field, stage, total (seconds), per_doc (seconds) and
+        share (of all busy time).
+        '''
+        busy = sum([totals["busy"] for totals in self.collections.values()])
+        rows = []
+        def add(collection, field, stage, total):
+            documents = self.collection(collection)["documents"]
+            rows.append({"collection": collection, "field": field,
+                         "stage": stage, "total": total,
+                         "per_doc": total / documents if documents else 0.0,
+                         "share": total / busy if busy else 0.0})
+
+        for (collection, field), times in self.fields.items():
+            for stage, total in zip(STAGES, times):
+                if total:
+                    add(collection, field, stage, total)
+        for collection, totals in self.collections.items():
+            add(collection, None, "write", totals["write"])
+            timed = sum([sum(times) for (name, field), times in
+                         self.fields.items() if name == collection])
+            # Building documents, id strategies, progress and the like.
+            add(collection, None, "other",
+                max(totals["busy"] - totals["write"] - timed, 0.0))
+        rows.sort(key=lambda row: row["total"], reverse=True)
+        return rows
+
+    def table(self):
+        '''
+        Return the ranked report as a printable table.
+        '''
+        lines = ["%-16s %-16s %-9s %10s %12s %7s" %
+                 ("collection", "field", "stage", "total (s)", "per doc (us)",
+                  "share")]
+        for row in self.rows():
+            lines.append("%-16s %-16s %-9s %10.3f %12.2f %6.1f%%" %
+                         (row["collection"], row["field"] or "-",
+                          row["stage"], row["total"], row["per_doc"] * 1e6,
+                          row["share"] * 100))
+        return "\n".join(lines)
+
+    def report(self):
+        '''
+        Return the report as a JSON-serializable dict.
+        '''
+        return {"collections": self.collections, "rows": self.rows()}
+
+    def write(self, path):
+        '''
+        Write the JSON report to a file.
+        :param path:
+        '''
+        with open(path, "w") as fp:
+            json.dump(self.report(), fp, indent=2, sort_keys=True)
+            fp.write("\n")
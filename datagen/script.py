@@ -6,14 +6,14 @@ Generate randomish data to fill up a sad, empty mongo database.
 import argparse
 import json
 import os
-import progressbar
-import pymongo
 import sys
 import time
 
-from datagen.output_methods import MongoInterface, StdoutInterface
+from datagen.output_methods import JsonLinesInterface, MongoInterface, \
+                                   PipelinedInterface, StdoutInterface
 from datagen import dictionaries
 from datagen import generator
+from datagen import telemetry
 
 __author__  = "Samantha Quinones"
 __email__   = "squinones@politico.com"
@@ -30,6 +30,18 @@ def parse_args():
                                                   mongo collection.")
     parser.add_argument("-n", "--no-progress", action="store_true", 
                         default=False, help="Do not display progress.")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        metavar="SECONDS", help="Seconds between progress \
+                              updates and metrics snapshots. Default: 1")
+    parser.add_argument("--metrics", type=str, default=None, metavar="FILE",
+                        help="Append a snapshot of each collection's \
+                              throughput, write latency and ETA to FILE \
+                              every interval.")
+    parser.add_argument("--metrics-format", type=str,
+                        choices=list(telemetry.MetricsFile.formats),
+                        default="jsonl", help="Format of the metrics file: \
+                              JSON Lines, or Prometheus text samples. \
+                              Default: jsonl")
     parser.add_argument("-e", "--encoding", type=str, choices=["html", 
                                                                "base64",
                                                                "ascii", 
@@ -39,6 +51,13 @@ def parse_args():
                         default=False,
                         help="Do not write to database. Instead, parse template\
                               and display output to stdout.")
+    parser.add_argument("-o", "--output-dir", type=str, default=None,
+                        help="Do not write to database. Instead, write each \
+                              collection to a JSON Lines file in this \
+                              directory, for loading with mongoimport.")
+    parser.add_argument("-z", "--compression", type=str,
+                        choices=["gzip", "zstd"], default=None,
+                        help="Compress JSON Lines output files.")
     parser.add_argument("--hostname", type=str, default="localhost",
                         help="Hostname with a MongoDB instance. Default: \
                               localhost")
@@ -50,6 +69,54 @@ def parse_args():
     parser.add_argument("-p", "--preserve-database", action="store_true", 
                         default=False, help="Do NOT overwrite existing \
                                              databases (appends new records)")
+    parser.add_argument("-b", "--batch-size", type=int, default=1000,
+                        help="Number of documents to write per batch. \
+                              Default: 1000")
+    parser.add_argument("--unordered", action="store_true", default=False,
+                        help="Use unordered bulk inserts. Faster, but a \
+                              failed document does not stop its batch.")
+    parser.add_argument("--writers", type=int, default=0,
+                        help="Number of writer threads. With 1 or more, \
+                              batches are written in the background while \
+                              the next ones are generated. Default: 0 \
+                              (write each batch before continuing)")
+    parser.add_argument("--engine", type=str, choices=["batch", "row"],
+                        default="batch", help="Document engine. 'batch' \
+                              builds a batch of documents one field at a \
+                              time, 'row' builds one document at a time. \
+                              Default: batch")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of worker processes. Collections \
+                              that do not refer to each other are generated \
+                              at the same time. Default: 1")
+    parser.add_argument("--share-dictionaries", action="store_true",
+                        default=False, help="With multiple workers, keep one \
+                              copy of each dictionary in shared memory for \
+                              all workers. Uses less memory per worker, but \
+                              sampling is slower.")
+    parser.add_argument("-s", "--seed", type=int, default=None,
+                        help="Random seed. Runs with the same seed and \
+                              template generate the same data. Default: a \
+                              new random seed")
+    parser.add_argument("--checkpoint", type=str, default=None, metavar="DIR",
+                        help="Save the run's progress, and the ids of \
+                              referenced collections, in DIR so it can be \
+                              resumed with --resume. Needs MongoDB output.")
+    parser.add_argument("--checkpoint-interval", type=float, default=30.0,
+                        metavar="SECONDS", help="Seconds between checkpoint \
+                              saves. Default: 30")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Resume the run checkpointed in --checkpoint \
+                              DIR, keeping the documents it wrote and \
+                              generating only the rest. Takes the seed from \
+                              the checkpoint.")
+    parser.add_argument("--profile", type=str, nargs="?", default=None,
+                        const="datagen-profile.json", metavar="REPORT",
+                        help="Time each field's generate, grammar and \
+                              encode stages, and the writes, and print a \
+                              ranked report when done. A JSON report is \
+                              written to REPORT. Default: \
+                              datagen-profile.json")
     parser.add_argument("--create-sample", action="store_true", default=False,
                         help="Write a sample template file to stdout and exit.")
     parser.add_argument("template", nargs="?",
@@ -72,33 +139,21 @@ def load_template(template_file):
 
     return template
 
-def create_pbar(name, count):
-    '''
-    Create a progress bar object
-    :param name:
-    :param count:
-    '''
-    pbar = progressbar.ProgressBar(widgets=[
-            ">>> ['%s'] Generated " % name,
-            progressbar.FormatLabel(" %(value)d documents "),
-            "of %d (" % count,
-            progressbar.Percentage(),
-            ")"],
-            maxval=count)
-    return pbar
-
-def load_mongo(hostname, port, dbname):
+def load_mongo(hostname, port, dbname, **options):
     '''
     Create a pymongo client
     :param hostname:
     :param port:
+    :param dbname:
     '''
+    import pymongo
     try:
         client = pymongo.MongoClient(hostname, port)
     except Exception as exc:
         raise Exception("Failed to connect to Mongo instance: %s" % str(exc))
     else: 
-        return MongoInterface(client, dbname)
+        return MongoInterface(client, dbname, hostname=hostname, port=port,
+                              **options)
 
 def print_sample_template():
     '''
@@ -131,37 +186,82 @@ def main(args):
     sys.stdout.write("done!\n")
     sys.stdout.flush()
     
+    output_config = {
+        "batch_size": args.batch_size,
+        "ordered": not args.unordered
+    }
     if args.test_output:
-        output = StdoutInterface() 
+        output = StdoutInterface(**output_config)
+    elif args.output_dir:
+        output = JsonLinesInterface(args.output_dir, args.compression,
+                                    **output_config)
     else:
-        output = load_mongo(args.hostname, args.port, args.dbname)
+        output = load_mongo(args.hostname, args.port, args.dbname,
+                            **output_config)
+
+    if args.writers > 0:
+        output = PipelinedInterface(output, args.writers)
+
+    if args.interval <= 0:
+        raise Exception("The progress interval must be greater than 0.")
+    if args.checkpoint_interval <= 0:
+        raise Exception("The checkpoint interval must be greater than 0.")
+    metrics = None
+    if args.metrics:
+        metrics = telemetry.MetricsFile(args.metrics, args.metrics_format)
 
     gen_config = {
         "use_pbar": not args.no_progress,
         "encoding": args.encoding,
         "preserve_database": args.preserve_database,
-        "names"  : dictionaries.NamesDictionary(),
-        "words"  : dictionaries.WordsDictionary(),
-        "lipsum" : dictionaries.LipsumDictionary(),
-        "numbers": dictionaries.NumbersDictionary()
+        "engine": args.engine,
+        "workers": args.workers,
+        "share_dictionaries": args.share_dictionaries,
+        "seed": args.seed,
+        "profile": args.profile is not None,
+        "interval": args.interval,
+        "metrics": metrics,
+        "checkpoint": args.checkpoint,
+        "checkpoint_interval": args.checkpoint_interval,
+        "resume": args.resume,
+        "dictionaries": dictionaries.DictionaryRegistry()
     }
-    gen = generator.Generator(template, output, create_pbar, **gen_config)
+    gen = generator.Generator(template, output, **gen_config)
+    print("* Using seed %d" % gen.seed)
+
+    # Compiling the template loads the dictionaries it uses.
+    gen.compile()
 
     # Print a message that we're starting the generation and trap the time.
     print("\nStarting data generation.")
     s_time = time.time()
     
-    gen.run()
+    try:
+        gen.run()
+    finally:
+        if metrics is not None:
+            metrics.close()
     
     print("\nData generation complete in %f seconds" % 
           (float(time.time()) - float(s_time)))
 
+    if gen.profiler is not None:
+        print("\nProfile (times summed over all workers):\n")
+        print(gen.profiler.table())
+        gen.profiler.write(args.profile)
+        print("\n* Profile report written to %s" % args.profile)
+
 def start():
     '''
     Start execution
     '''
     try:
-        main(parse_args())
+        if sys.argv[1:2] == ["bench"]:
+            from datagen import bench
+            status = bench.main(sys.argv[2:])
+        else:
+            main(parse_args())
+            status = 0
     except KeyboardInterrupt:
         sys.stdout.flush()
         print("\nCancelled!\n")
@@ -170,4 +270,4 @@ def start():
         print(str(exc))
         sys.exit(-1)
     else:
-        sys.exit(0)
+        sys.exit(status)
@@ -0,0 +1,205 @@
+'''
+sharding.py
+
+Multi-process generation of a single collection. The collection's document
+count is split into shards and each shard is generated and written by its own
+worker process.
+'''
+import gc
+
+from datagen import idstore
+from datagen import streams
+
+# Set in each worker process by _init_worker().
+_generator = None
+_telemetry = None
+
+def split_ranges(count, shards):
+    '''
+    Split a document count into at most `shards` near-equal (start, stop)
+    ranges. Boundaries fall on stream blocks, so no block is generated twice.
+    :param count:
+    :param shards:
+    '''
+    blocks = -(-count // streams.BLOCK_SIZE)
+    shards = max(1, min(shards, blocks))
+    base, extra = divmod(blocks, shards)
+    ranges = []
+    block  = 0
+    for i in range(shards):
+        end = block + base + (1 if i < extra else 0)
+        ranges.append((block * streams.BLOCK_SIZE,
+                       min(end * streams.BLOCK_SIZE, count)))
+        block = end
+    return ranges
+
+class ShardedRun(object):
+    '''
+    A collection being generated by its own pool of worker processes. The
+    pool is started when the run is created; several runs can be in progress
+    at once.
+    '''
+    def __init__(self, generator, plan, workers, keep_ids=True,
+                 telemetry=None, ranges=None):
+        '''
+        Split the collection into shards and start the workers.
+        :param generator:       Generator instance. Workers inherit it, its
+                                compiled plans and the ids collected so far,
+                                by forking.
+        :param plan:            CollectionPlan for the collection.
+        :param workers:         Maximum number of worker processes.
+        :param keep_ids:
+        :param telemetry:       Optional telemetry.Telemetry with a row for
+                                each shard. Workers count into it; the run
+                                polls it for display.
+        :param ranges:          Optional (start, stop, written) range of each
+                                shard, with documents [start, written)
+                                already written. Defaults to split_ranges().
+        '''
+        import multiprocessing
+        try:
+            context = multiprocessing.get_context("fork")
+        except ValueError:
+            raise Exception("Multiple workers require the 'fork' process \
+                             start method, which this platform does not \
+                             support.")
+
+        # Publish the dictionaries in shared memory before forking, so every
+        # worker samples the same physical copy of each word table.
+        if generator.options.get("share_dictionaries"):
+            for dictionary in generator.dbs.values():
+                dictionary.share()
+
+        if ranges is None:
+            ranges = [(start, stop, start) for start, stop
+                      in split_ranges(plan.count, workers)]
+        index  = generator.plans.index(plan)
+        shards = [(index, shard) + tuple(item) + (keep_ids,)
+                  for shard, item in enumerate(ranges)]
+
+        self.plan       = plan
+        self.profiler   = generator.profiler
+        self.workers    = min(workers, len(shards))
+        self.keep_ids   = keep_ids
+        self.telemetry  = telemetry
+        self.checkpoint = generator.checkpoint
+        self.estimate   = None  # SizeEstimate of a size-targeted collection
+
+        # Move everything allocated so far out of the collector's reach. A
+        # collection in a worker would otherwise write to every inherited
+        # object and unshare the pages holding them.
+        gc.freeze()
+        self.pool    = context.Pool(self.workers, _init_worker,
+                                    (generator, telemetry))
+        self.result  = self.pool.map_async(_generate_shard, shards,
+                                           chunksize=1)
+
+    def report(self):
+        '''
+        Update the telemetry display and save the checkpoint if they are
+        due.
+        '''
+        if self.telemetry is not None:
+            self.telemetry.poll()
+        if self.checkpoint is not None:
+            self.checkpoint.poll()
+
+    def poll(self, timeout=0):
+        '''
+        Wait up to `timeout` seconds for the run to finish, reporting
+        progress. Returns True once every shard is done.
+        :param timeout:
+        '''
+        self.result.wait(timeout)
+        self.report()
+        return self.result.ready()
+
+    def finish(self):
+        '''
+        Wait for the run and shut down its pool. Returns an IdStore of the
+        written ids in shard order, or None if they are not kept. Raises any
+        error a worker hit.
+        '''
+        try:
+            while not self.poll(0.2):
+                pass
+            shards = self.result.get()
+            self.pool.close()
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            gc.unfreeze()
+
+        for shard_ids, snapshot, estimate in shards:
+            if snapshot is not None:
+                self.profiler.merge(snapshot)
+            if estimate is not None:
+                self.estimate = estimate
+        if not self.keep_ids:
+            return None
+        ids = idstore.IdStore()
+        for shard_ids, snapshot, estimate in shards:
+            ids.merge(shard_ids)
+        return ids
+
+def generate_sharded(generator, plan, workers, keep_ids=True,
+                     telemetry=None, ranges=None):
+    '''
+    Generate a collection across `workers` processes. Returns an IdStore of
+    the written ids in shard order, or None if `keep_ids` is False.
+    :param generator:
+    :param plan:
+    :param workers:
+    :param keep_ids:
+    :param telemetry:
+    :param ranges:
+    '''
+    return ShardedRun(generator, plan, workers, keep_ids, telemetry,
+                      ranges).finish()
+
+def _init_worker(generator, telemetry):
+    '''
+    Worker initializer. Gives the worker its own output connection.
+    :param generator:
+    :param telemetry:
+    '''
+    global _generator, _telemetry
+    generator.output = generator.output.clone()
+    _generator = generator
+    _telemetry = telemetry
+
+def _generate_shard(shard):
+    '''
+    Generate and write one shard. Returns an IdStore of the written ids, or
+    None if they are not kept, a profiler snapshot of the shard, or None if
+    the run is not profiled, and the SizeEstimate of a size-targeted
+    collection, or None.
+    :param shard:           (plan index, shard number, start, stop, written,
+                            keep_ids) tuple.
+    '''
+    index, row, start, stop, written, keep_ids = shard
+    plan = _generator.plans[index]
+    if _generator.profiler is not None:
+        _generator.profiler.reset()
+    # Each shard counts into its own row of the shared telemetry counters.
+    progress = None
+    if _telemetry is not None:
+        counters = _telemetry.counters
+        progress = lambda finished: counters.add_documents(row, finished)
+        _generator.output.set_monitor(_telemetry.recorder(row))
+    # A resumed shard carries on after the documents already written, with
+    # their ids.
+    ids = _generator.range_ids(plan, row, start, written, keep_ids)
+    log = None
+    if _generator.checkpoint is not None:
+        log = _generator.checkpoint.log(plan.name, row, keep_ids)
+    estimate = _generator.size_estimate(plan, written)
+    try:
+        ids = _generator.generate_documents(plan, written, stop, progress, ids,
+                                            log, estimate)
+    finally:
+        if log is not None:
+            log.close()
+    if _generator.profiler is not None:
+        return ids, _generator.profiler.snapshot(), estimate
+    return ids, None, estimate
@@ -0,0 +1,117 @@
+'''
+sizing.py
+
+Size-targeted collections.
+
+A collection with a "target_size" instead of a "count" is generated until
+the BSON size of its documents reaches the target. Documents are not encoded
+to measure them, which would encode each one twice, once here and once by
+the driver: the first SAMPLE documents of the collection are encoded, and
+after them one document in every EVERY. Each document is counted as the size
+of the last document measured at or before it, so the estimate follows any
+drift in document sizes as the collection grows.
+
+Which documents are measured depends only on their position in the
+collection, and documents are a pure function of the seed, so a collection
+always stops after the same document.
+'''
+import re
+
+SAMPLE  = 1024  # Documents measured at the start of a collection
+EVERY   = 32    # Then one document in this many. Divides streams.BLOCK_SIZE,
+                # so every document is in the block of the last measured one
+ID_SIZE = 17    # BSON size of the ObjectId _id the driver adds
+
+UNITS = {
+    "b":   1,
+    "kb":  1000,
+    "mb":  1000 ** 2,
+    "gb":  1000 ** 3,
+    "tb":  1000 ** 4,
+    "kib": 1024,
+    "mib": 1024 ** 2,
+    "gib": 1024 ** 3,
+    "tib": 1024 ** 4
+}
+
+def parse_size(value):
+    '''
+    Parse a size: a number of bytes, or a string of a number and a unit,
+    such as "500GB" or "1.5 GiB". Returns the size in bytes, or None if the
+    value is not a size.
+    :param value:
+    '''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if not isinstance(value, str):
+        return None
+    match = re.match(r"^\s*([0-9]*\.?[0-9]+)\s*([a-z]*)\s*$", value.lower())
+    if match is None or (match.group(2) or "b") not in UNITS:
+        return None
+    return int(float(match.group(1)) * UNITS[match.group(2) or "b"])
+
+def format_size(size):
+    '''
+    Format a number of bytes for display, in decimal units.
+    :param size:
+    '''
+    for unit in ("TB", "GB", "MB", "kB"):
+        if size >= UNITS[unit.lower()]:
+            return "%.2f %s" % (float(size) / UNITS[unit.lower()], unit)
+    return "%d bytes" % size
+
+class SizeEstimate(object):
+    '''
+    The estimated BSON size of the documents of a size-targeted collection
+    generated so far.
+    '''
+    def __init__(self, target, count=0, size=0):
+        '''
+        :param target:          Target size, in bytes.
+        :param count:           Documents already generated.
+        :param size:            Their estimated size.
+        '''
+        import bson
+        self.target = target
+        self.count  = count
+        self.size   = size
+        self.encode = bson.encode
+
+    @property
+    def done(self):
+        return self.size >= self.target
+
+    def measure(self, documents, index):
+        '''
+        Return the estimated size of each document in `documents`, the
+        documents of the collection from `index` on. The first document
+        must be one that is measured.
+        :param documents:
+        :param index:
+        '''
+        encode = self.encode
+        sizes  = []
+        size   = None
+        for document in documents:
+            if index < SAMPLE or index % EVERY == 0:
+                size = len(encode(document))
+                if "_id" not in document:
+                    size = size + ID_SIZE
+            sizes.append(size)
+            index = index + 1
+        return sizes
+
+    def add(self, sizes):
+        '''
+        Count documents of the given sizes, in order, until the target is
+        reached. Returns the number counted.
+        :param sizes:
+        '''
+        for counted, size in enumerate(sizes):
+            if self.size >= self.target:
+                return counted
+            self.size  = self.size + size
+            self.count = self.count + 1
+        return len(sizes)
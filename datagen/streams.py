@@ -0,0 +1,93 @@
+'''
+streams.py
+
+Counter-based random streams.
+
+Documents are generated in blocks of BLOCK_SIZE. Every block draws from its
+own stream, keyed by (seed, collection, block number), so any range of a
+collection can be generated without generating what comes before it, and the
+output does not depend on how a run is split up.
+'''
+import hashlib
+import importlib.util
+import os
+import random
+
+_numpy = None       # NumPy module, once imported
+
+BLOCK_SIZE = 256    # Documents per stream
+
+class Stream(random.Random):
+    '''
+    A random.Random seeded from a 128-bit key. The matching NumPy generator,
+    a Philox counter-based generator on the same key, is created on first use.
+    '''
+    block = None    # Block number, for streams made by block_stream()
+
+    def __init__(self, key=None):
+        '''
+        Create a stream.
+        :param key:             128-bit integer key. Defaults to a key read
+                                from os.urandom().
+        '''
+        if key is None:
+            key = int.from_bytes(os.urandom(16), "big")
+        self.key    = key
+        self._numpy = None
+        random.Random.__init__(self, key)
+
+    @property
+    def numpy(self):
+        '''
+        numpy.random.Generator for this stream.
+        '''
+        if self._numpy is None:
+            numpy = get_numpy()
+            self._numpy = numpy.random.Generator(
+                numpy.random.Philox(key=self.key))
+        return self._numpy
+
+def numpy_available():
+    '''
+    Return True if NumPy is installed, without importing it.
+    '''
+    return _numpy is not None or importlib.util.find_spec("numpy") is not None
+
+def get_numpy():
+    '''
+    Import NumPy on first use and return it. Runs that never touch the NumPy
+    backend do not pay for the import.
+    '''
+    global _numpy
+    if _numpy is None:
+        import numpy
+        _numpy = numpy
+    return _numpy
+
+def derive_key(seed, *parts):
+    '''
+    Hash a seed and any number of key parts to a 128-bit integer.
+    :param seed:
+    :param parts:
+    '''
+    digest = hashlib.blake2b(str(seed).encode("utf-8"), digest_size=16)
+    for part in parts:
+        digest.update(b"\0" + str(part).encode("utf-8"))
+    return int.from_bytes(digest.digest(), "big")
+
+def block_stream(seed, collection, block):
+    '''
+    Return the stream for one block of a collection.
+    :param seed:
+    :param collection:
+    :param block:
+    '''
+    stream       = Stream(derive_key(seed, collection, block))
+    stream.block = block
+    return stream
+
+def new_seed():
+    '''
+    Return a fresh 64-bit seed for runs that do not specify one.
+    '''
+    return random.SystemRandom().getrandbits(64)
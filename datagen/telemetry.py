@@ -0,0 +1,307 @@
+'''
+telemetry.py
+
+Live throughput for each collection: documents and bytes per second, write
+latency percentiles and time remaining.
+
+Counters are kept in anonymous shared memory with one row per worker, so
+forked workers update them without locks or messages. The main process reads
+them on a time interval, redraws a status line and can append a snapshot to
+a metrics file, as JSON Lines or Prometheus text.
+'''
+import json
+import math
+import mmap
+import sys
+import threading
+import time
+
+# Columns of a counter row. LATENCY is the first of BUCKETS histogram buckets.
+DOCUMENTS = 0       # Documents generated
+WRITES    = 1       # Batches written
+SIZED     = 2       # Batches written whose size is known
+BYTES     = 3       # Total size of the sized batches
+LATENCY   = 4
+
+BUCKETS = 40        # Write latency buckets
+BASE    = 0.0001    # Upper bound of the first bucket, in seconds
+GROWTH  = 1.5       # Ratio between the bounds of neighbouring buckets
+ROW     = LATENCY + BUCKETS
+
+def bucket(seconds):
+    '''
+    Return the latency bucket for a write time.
+    :param seconds:
+    '''
+    if seconds <= BASE:
+        return 0
+    return min(int(math.ceil(math.log(seconds / BASE, GROWTH))), BUCKETS - 1)
+
+def percentile(histogram, fraction):
+    '''
+    Return the upper bound of the bucket holding a percentile of a latency
+    histogram, in seconds, or None if it is empty.
+    :param histogram:       List of bucket counts.
+    :param fraction:        Percentile as a fraction, e.g. 0.95.
+    '''
+    total = sum(histogram)
+    if not total:
+        return None
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen = seen + count
+        if seen >= fraction * total:
+            return BASE * GROWTH ** index
+    return BASE * GROWTH ** (BUCKETS - 1)
+
+class Counters(object):
+    '''
+    Counters for one collection, in memory shared with forked workers. Each
+    worker only writes its own row; the main process sums them.
+    '''
+    def __init__(self, rows=1):
+        '''
+        :param rows:            Number of workers that will write.
+        '''
+        self.rows   = rows
+        self.memory = mmap.mmap(-1, rows * ROW * 8)
+        self.values = memoryview(self.memory).cast("q")
+        self.lock   = threading.Lock()  # Writer threads share a row
+
+    def add_documents(self, row, count):
+        '''
+        Count generated documents.
+        :param row:
+        :param count:
+        '''
+        self.values[row * ROW + DOCUMENTS] += count
+
+    def add_write(self, row, seconds, size=None):
+        '''
+        Count a written batch.
+        :param row:
+        :param seconds:         Time the write took.
+        :param size:            Bytes written, or None if unknown.
+        '''
+        base = row * ROW
+        with self.lock:
+            self.values[base + WRITES] += 1
+            self.values[base + LATENCY + bucket(seconds)] += 1
+            if size is not None:
+                self.values[base + SIZED] += 1
+                self.values[base + BYTES] += size
+
+    def total(self, column):
+        '''
+        Return a column summed over every row.
+        :param column:
+        '''
+        return sum(self.values[column::ROW])
+
+    def histogram(self):
+        '''
+        Return the write latency histogram summed over every row.
+        '''
+        return [self.total(LATENCY + index) for index in range(BUCKETS)]
+
+class Telemetry(object):
+    '''
+    Tracks one collection. Every `interval` seconds its counters are read to
+    redraw the status line and append a metrics snapshot.
+    '''
+    def __init__(self, collection, count, rows=1, interval=1.0, show=True,
+                 metrics=None):
+        '''
+        :param collection:      Collection name.
+        :param count:           Number of documents to generate, or None if
+                                it is not known up front.
+        :param rows:            Number of workers.
+        :param interval:        Seconds between updates.
+        :param show:            Draw a status line on stderr.
+        :param metrics:         Optional MetricsFile.
+        '''
+        self.collection = collection
+        self.count      = count
+        self.interval   = interval
+        self.show       = show
+        self.metrics    = metrics
+        self.counters   = Counters(rows)
+        self.started    = time.time()
+        self.last       = (self.started, 0, 0)  # (time, documents, bytes)
+        self.width      = 0
+
+    def progress(self, finished, row=0):
+        '''
+        Count generated documents and update the display if it is due. Used
+        as the progress callable of Generator.generate_documents().
+        :param finished:
+        :param row:
+        '''
+        self.counters.add_documents(row, finished)
+        self.poll()
+
+    def recorder(self, row=0):
+        '''
+        Return an output monitor, which counts the writes of one worker.
+        :param row:
+        '''
+        add_write = self.counters.add_write
+        def monitor(seconds, size):
+            add_write(row, seconds, size)
+        return monitor
+
+    def poll(self, force=False):
+        '''
+        Update the display and metrics if `interval` seconds have passed.
+        :param force:
+        '''
+        now = time.time()
+        if force or now - self.last[0] >= self.interval:
+            self.update(now)
+
+    def snapshot(self, now):
+        '''
+        Return the collection's current figures as a dict.
+        :param now:
+        '''
+        counters  = self.counters
+        documents = counters.total(DOCUMENTS)
+        size      = counters.total(BYTES)
+        histogram = counters.histogram()
+        last_time, last_documents, last_size = self.last
+        elapsed   = max(now - last_time, 1e-9)
+        average   = documents / max(now - self.started, 1e-9)
+        snapshot  = {
+            "time":          now,
+            "collection":    self.collection,
+            "documents":     documents,
+            "count":         self.count,
+            "docs_per_sec":  (documents - last_documents) / elapsed,
+            "bytes":         None,
+            "bytes_per_sec": None,
+            "writes":        counters.total(WRITES),
+            "latency_p50":   percentile(histogram, 0.50),
+            "latency_p95":   percentile(histogram, 0.95),
+            "latency_p99":   percentile(histogram, 0.99),
+            "eta":           ((self.count - documents) / average
+                              if average and self.count is not None
+                              else None)
+        }
+        if counters.total(SIZED):
+            snapshot["bytes"]         = size
+            snapshot["bytes_per_sec"] = (size - last_size) / elapsed
+        self.last = (now, documents, size)
+        return snapshot
+
+    def update(self, now):
+        '''
+        Take a snapshot, redraw the status line and write the snapshot to the
+        metrics file.
+        :param now:
+        '''
+        snapshot = self.snapshot(now)
+        if self.show:
+            line = format_status(snapshot)
+            sys.stderr.write("\r" + line.ljust(self.width))
+            sys.stderr.flush()
+            self.width = len(line)
+        if self.metrics is not None:
+            self.metrics.write(snapshot)
+
+    def finish(self):
+        '''
+        Write the final figures and end the status line. Their rates are
+        averages over the whole collection.
+        '''
+        self.last = (self.started, 0, 0)
+        self.update(time.time())
+        if self.show:
+            sys.stderr.write("\n")
+            sys.stderr.flush()
+
+def format_status(snapshot):
+    '''
+    Format a snapshot as a one-line status.
+    :param snapshot:
+    '''
+    count = snapshot["count"]
+    if count is None:
+        parts = [">>> ['%s'] %d" % (snapshot["collection"],
+                                    snapshot["documents"])]
+    else:
+        parts = [">>> ['%s'] %d/%d (%.1f%%)" %
+                 (snapshot["collection"], snapshot["documents"], count,
+                  100.0 * snapshot["documents"] / count if count else 100.0)]
+    parts.append("%.0f docs/s" % snapshot["docs_per_sec"])
+    if snapshot["bytes_per_sec"] is not None:
+        parts.append("%.2f MB/s" % (snapshot["bytes_per_sec"] / 1e6))
+    if snapshot["latency_p50"] is not None:
+        parts.append("write p50/p95/p99 %s/%s/%s ms" %
+                     tuple(["%.3g" % (snapshot[key] * 1000) for key in
+                            ("latency_p50", "latency_p95", "latency_p99")]))
+    if snapshot["eta"] is not None:
+        eta = int(snapshot["eta"])
+        parts.append("ETA %d:%02d:%02d" % (eta // 3600, eta // 60 % 60,
+                                            eta % 60))
+    return " | ".join(parts)
+
+class MetricsFile(object):
+    '''
+    Appends telemetry snapshots to a file, as JSON Lines or as Prometheus
+    text exposition samples with timestamps.
+    '''
+    formats = ("jsonl", "prometheus")
+
+    def __init__(self, path, format="jsonl"):
+        '''
+        :param path:
+        :param format:          "jsonl" or "prometheus".
+        '''
+        if format not in self.formats:
+            raise Exception("Invalid metrics format '%s' specified" % format)
+        self.format = format
+        try:
+            self.fp = open(path, "a")
+        except OSError as exc:
+            raise Exception("Metrics file '%s' could not be opened: %s" %
+                            (path, str(exc)))
+
+    def write(self, snapshot):
+        '''
+        Append one snapshot.
+        :param snapshot:
+        '''
+        if self.format == "jsonl":
+            self.fp.write(json.dumps(snapshot, sort_keys=True) + "\n")
+        else:
+            self.fp.write(prometheus(snapshot))
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+def prometheus(snapshot):
+    '''
+    Format a snapshot as Prometheus text exposition samples.
+    :param snapshot:
+    '''
+    stamp  = int(snapshot["time"] * 1000)
+    label  = 'collection="%s"' % snapshot["collection"].replace(
+        "\\", "\\\\").replace('"', '\\"')
+    lines  = []
+    def sample(name, value, extra=""):
+        if value is not None:
+            lines.append("datagen_%s{%s%s} %r %d\n" %
+                         (name, label, extra, float(value), stamp))
+    sample("documents_total", snapshot["documents"])
+    sample("documents_target", snapshot["count"])
+    sample("documents_per_second", snapshot["docs_per_sec"])
+    sample("bytes_total", snapshot["bytes"])
+    sample("bytes_per_second", snapshot["bytes_per_sec"])
+    sample("writes_total", snapshot["writes"])
+    for key, quantile in (("latency_p50", "0.5"), ("latency_p95", "0.95"),
+                          ("latency_p99", "0.99")):
+        sample("write_latency_seconds", snapshot[key],
+               ',quantile="%s"' % quantile)
+    sample("eta_seconds", snapshot["eta"])
+    return "".join(lines)
@@ -0,0 +1,127 @@
+'''
+textpool.py
+
+Pre-rendered text for large text fields.
+
+A field with a "text_pool" renders a pool of sentences (or, for grammars other
+than body, runs of words) once, with its dictionary and grammar, and builds
+each document's text by sampling whole entries from the pool until the text
+reaches the field's size. Assembling text this way costs a few random draws
+and a join per document instead of sampling and formatting every word.
+
+The pool is rebuilt every `refresh` documents, rounded up to whole stream
+blocks, so any one entry is only repeated within a bounded run of documents.
+Each pool is drawn from its own stream, keyed by the seed, collection, field
+and pool number, so the output does not depend on how a run is split up.
+'''
+from datagen import grammars
+from datagen import streams
+
+ENTRY_SIZE = (8, 12)    # Words per entry, like a body's sentence lengths
+ENTRIES    = 1000       # Default pool size
+REFRESH    = 10000      # Default documents between pool rebuilds
+
+class TextPool(object):
+    '''
+    A pool of rendered entries for one field.
+    '''
+    def __init__(self, seed, collection, field, dictionary, grammar,
+                 paragraphs, entries=ENTRIES, refresh=REFRESH,
+                 distribution=None):
+        '''
+        :param seed:            Run seed.
+        :param collection:      Collection name.
+        :param field:           Field name.
+        :param dictionary:      Dictionary the entries' words are drawn from.
+        :param grammar:         Callable, grammar(data, rng), rendering an
+                                entry's words.
+        :param paragraphs:      Group entries into paragraphs, as body does.
+        :param entries:         Number of entries in the pool.
+        :param refresh:         Documents between pool rebuilds.
+        :param distribution:    Optional distributions.AliasTable picking the
+                                entries' words.
+        '''
+        self.seed         = seed
+        self.collection   = collection
+        self.field        = field
+        self.dictionary   = dictionary
+        self.grammar      = grammar
+        self.paragraphs   = paragraphs
+        self.entries      = entries
+        self.distribution = distribution
+        self.blocks       = max(1, -(-refresh // streams.BLOCK_SIZE))
+        self.current      = None  # (pool number, texts, word counts)
+
+    def pool(self, rng):
+        '''
+        Return the (texts, word counts) of the pool serving the block `rng`
+        was created for, building it if needed. Only the latest pool is kept.
+        :param rng:
+        '''
+        number = (rng.block or 0) // self.blocks
+        if self.current is None or self.current[0] != number:
+            self.current = (number,) + self.build(number)
+        return self.current[1], self.current[2]
+
+    def build(self, number):
+        '''
+        Render pool `number`. Returns (texts, word counts).
+        :param number:
+        '''
+        rng   = streams.Stream(streams.derive_key(self.seed, self.collection,
+                                                  self.field, "text_pool",
+                                                  number))
+        data  = self.dictionary.generate_batch(self.entries, size=ENTRY_SIZE,
+                                               rng=rng,
+                                               distribution=self.distribution)
+        texts = [self.grammar(words, rng).strip() for words in data]
+        return texts, [len(words) for words in data]
+
+    def render(self, sizes, rng):
+        '''
+        Return a text for each size in `sizes`: whole entries drawn at random
+        until the text has at least that many words.
+        :param sizes:           Word counts.
+        :param rng:
+        '''
+        texts, counts = self.pool(rng)
+        entries = len(texts)
+        average = max(sum(counts) / float(entries), 1.0)
+        random  = rng.random
+        output  = []
+        for size in sizes:
+            picks = []
+            words = 0
+            while words < size:
+                # Draw about as many entries as the size needs, then a few at
+                # a time for any shortfall.
+                for i in range(max(int((size - words) / average), 1)):
+                    pick  = int(random() * entries)
+                    picks.append(texts[pick])
+                    words = words + counts[pick]
+                    if words >= size:
+                        break
+            if self.paragraphs:
+                output.append(paragraphs(picks, rng))
+            else:
+                output.append(" ".join(picks))
+        return output
+
+def paragraphs(sentences, rng):
+    '''
+    Group sentences into tab-indented paragraphs of 3 to 6 sentences, laid
+    out like grammars.body().
+    :param sentences:
+    :param rng:
+    '''
+    if not sentences:
+        return "\n\n"
+    lengths = grammars.draw_offsets(rng, len(sentences) // 3 + 1)
+    output  = []
+    pos     = 0
+    for offset in lengths:
+        if pos >= len(sentences):
+            break
+        output.append(" ".join(sentences[pos:pos + 3 + offset]))
+        pos = pos + 3 + offset
+    return "\t" + "\n\n\t".join(output) + "\n\n"
@@ -14,7 +14,8 @@ setup(name = "datagen",
       
       include_package_data = True,
       package_data = {'': ['distribute_setup.py', 'templates/*'], 'datagen': ['data/*']},
-      install_requires = ["progressbar>=2.3", "pymongo>=2.4.2"],
+      install_requires = ["pymongo>=3.0"],
+      extras_require = {"numpy": ["numpy>=1.17"], "zstd": ["zstandard"]},
       zip_safe = False,
       entry_points = {
             'console_scripts': ['datagen = datagen.script:start']
@@ -0,0 +1,79 @@
+'''
+frozen_grammars.py
+
+The sentence() and body() grammar transforms as they were before their
+draws were taken in bulk. Kept unchanged for test_grammars.py: the current
+functions must give the same text and leave the stream in the same state.
+'''
+import io
+import random
+
+def randomize(value, bound, rng=random):
+    '''
+    Returns a a random value+/- bound
+    :param value:
+    :param bound:
+    :param rng:             Stream to draw from. Defaults to the random module.
+    '''
+    return rng.randrange((value - bound),(value + bound))
+
+def sentence(data, **options):
+    '''
+    Returns string with first word capitalized and punctuation added.
+    :param data:
+    '''
+    
+    rng        = options.get("rng") or random
+    last_comma = 0
+    last_semic = 0
+    
+    output = []
+    for i in range(len(data)):
+        comma_freq = randomize(options.get("comma_freq", 7), 2, rng)
+        semic_freq = randomize(options.get("semiq_freq", 15), 2, rng) 
+
+        word = str(data[i]).lower()
+        if i == 0:
+            word = word.capitalize()
+        
+        
+        if (last_comma + comma_freq) < i:
+            word = word + ","
+
+        if (last_semic + semic_freq) < i:
+            word = word + ";"
+            
+        output.append(word)
+    
+    return " ".join(output) + ". "
+        
+def body(data, **options):
+    '''
+    Returns string of sentences with paragraphs
+    :param data:
+    '''
+    rng    = options.get("rng") or random
+    output = io.StringIO()
+    output.write("\t")
+
+    para_len     = randomize(options.get("para_len", 5), 2, rng)
+    pos          = 0
+    sentences    = 0
+    
+    while True:
+        # Slice out a sentence worth of data and transform it to a sentence.
+        sentence_len = randomize(options.get("sentence_len", 10), 2, rng)
+        sliced = data[pos:(pos+sentence_len)]
+        if len(sliced) > 0:
+            output.write(sentence(sliced, **options))
+            sentences = sentences + 1
+            pos       = pos + sentence_len
+            if sentences >= para_len:
+                output.write("\n\n\t")
+                para_len = randomize(options.get("para_len", 5), 2, rng)
+        else:
+            break
+    
+    text_body = output.getvalue().rstrip() + "\n\n"
+    output.close()
+    return text_body
@@ -0,0 +1,90 @@
+'''
+test_determinism.py
+
+Checks that a seeded run writes the same documents for any number of
+workers, and so for any slicing of its collections into shards.
+'''
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from datagen import dictionaries
+from datagen import generator
+from datagen import streams
+from datagen.output_methods import JsonLinesInterface
+
+COUNT   = 700
+WORKERS = (1, 2, 3)
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "templates", "template.json")
+
+def load_template():
+    '''
+    Return the sample template, with COUNT documents per collection and
+    deterministic ids, so that references do not depend on the start time.
+    '''
+    with open(TEMPLATE, "r") as fp:
+        template = json.load(fp)
+    for collection in template:
+        collection["count"]       = COUNT
+        collection["id_strategy"] = "deterministic"
+    return template
+
+def output_hashes(engine, workers, use_numpy):
+    '''
+    Run the sample template with seed 42 and return a hash of each
+    collection's documents. Workers write in any order, so lines are sorted
+    before hashing.
+    :param engine:
+    :param workers:
+    :param use_numpy:
+    '''
+    directory = tempfile.mkdtemp()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            registry = dictionaries.DictionaryRegistry(use_numpy=use_numpy)
+            gen      = generator.Generator(
+                load_template(), JsonLinesInterface(directory, batch_size=100),
+                use_pbar=False, preserve_database=False, seed=42,
+                engine=engine, workers=workers, dictionaries=registry)
+            gen.run()
+        hashes = {}
+        for filename in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, filename), "rb") as fp:
+                lines = sorted(fp.read().splitlines())
+            hashes[filename] = hashlib.sha256(b"\n".join(lines)).hexdigest()
+        return hashes
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+class DeterminismTest(unittest.TestCase):
+
+    def check(self, engine, use_numpy):
+        expected = output_hashes(engine, WORKERS[0], use_numpy)
+        self.assertEqual(sorted(expected), ["authors.jsonl", "stories.jsonl"])
+        for workers in WORKERS[1:]:
+            self.assertEqual(expected,
+                             output_hashes(engine, workers, use_numpy),
+                             "%s engine, %d workers" % (engine, workers))
+
+    def test_batch(self):
+        self.check("batch", False)
+
+    def test_row(self):
+        self.check("row", False)
+
+    @unittest.skipUnless(streams.numpy_available(), "NumPy is not installed")
+    def test_batch_numpy(self):
+        self.check("batch", True)
+
+    @unittest.skipUnless(streams.numpy_available(), "NumPy is not installed")
+    def test_row_numpy(self):
+        self.check("row", True)
+
+if __name__ == "__main__":
+    unittest.main()
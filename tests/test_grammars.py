@@ -0,0 +1,78 @@
+'''
+test_grammars.py
+
+Checks the grammar transforms against the frozen copies of the functions
+they replaced, so a change to the generated text or to the draws it takes
+does not go unnoticed.
+'''
+import random
+import unittest
+
+from datagen import grammars
+from datagen import streams
+
+import frozen_grammars
+
+TRIALS = 3000
+LENGTHS = (0, 1, 2, 5, 9, 10, 11, 17, 30, 50, 120, 500)
+VOCABULARY = ["x\0y", "Lorem", "IPSUM", "dolor", "ΣΊΣΥΦΟΣ",
+              "straße", "", "İstanbul", "a b", 3]
+
+def trial_input(trial):
+    '''
+    Return the words and options of one trial: random words, and every third
+    trial random options, including out of range ones.
+    :param trial:
+    '''
+    rng     = random.Random(trial)
+    data    = [rng.choice(VOCABULARY) for i in range(rng.choice(LENGTHS))]
+    options = {}
+    if trial % 3 == 0:
+        options = {
+            "comma_freq":   rng.randint(-3, 9),
+            "semiq_freq":   rng.randint(-3, 20),
+            "para_len":     rng.randint(-2, 7),
+            "sentence_len": rng.randint(2, 13)
+        }
+    return data, options
+
+class GrammarEquivalenceTest(unittest.TestCase):
+
+    def check(self, name, seeded):
+        '''
+        Compare a transform with its frozen copy over TRIALS inputs.
+        :param name:            Name of the transform.
+        :param seeded:          Callable returning a stream for a seed.
+        '''
+        for trial in range(TRIALS):
+            data, options = trial_input(trial)
+            old_rng = seeded(trial)
+            new_rng = seeded(trial)
+            old     = getattr(frozen_grammars, name)(data, rng=old_rng,
+                                                     **options)
+            new     = getattr(grammars, name)(data, rng=new_rng, **options)
+            self.assertEqual(old, new, "%s, trial %d" % (name, trial))
+            self.assertEqual(old_rng.random(), new_rng.random(),
+                             "%s, trial %d: stream state" % (name, trial))
+
+    def test_sentence(self):
+        self.check("sentence", random.Random)
+
+    def test_body(self):
+        self.check("body", random.Random)
+
+    def test_body_stream(self):
+        self.check("body", lambda seed: streams.Stream(
+            streams.derive_key(seed)))
+
+    def test_draw_offsets(self):
+        for count in range(0, 300, 7):
+            old_rng = random.Random(count)
+            new_rng = random.Random(count)
+            old     = bytes([frozen_grammars.randomize(7, 2, old_rng) - 5
+                             for i in range(count)])
+            self.assertEqual(old, grammars.draw_offsets(new_rng, count))
+            self.assertEqual(old_rng.random(), new_rng.random())
+
+if __name__ == "__main__":
+    unittest.main()